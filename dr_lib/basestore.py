@@ -3,9 +3,9 @@
 Base class for a store.
 
 A store maintains the actual debian packages in the filesystem.
-Packages can be added and removed from the store. Packages are
-always added or removed from a store before being added or removed
-from the database.
+Packages can be added and removed from the store. Where possible, the
+database is changed before the store, as changes of the store are not
+rolled back with those of the database when something fails.
 
 A store implements the following methods:
 
@@ -13,7 +13,7 @@ A store implements the following methods:
     Initialization. All data needed from the passed config must be
     copied into the object.
 
-    In the BaseStore only config.root is copied
+    In the BaseStore only config.root and config.placement are copied
 
   pkgDir(self, pkg, component, release) : mandatory
     Given a package object, component and release, return the directory
@@ -23,17 +23,31 @@ A store implements the following methods:
     Add a new package to the repository with the given component and
     release. The package does not yet exist in the repository.
     Must add the `Filename` property to the pkg object, holding
-    the name of the package relative to the repository root.
+    the name of the package relative to the repository root. Called
+    after the package has been added to the database under the
+    Filename set by binPrepareAdd.
 
     In the BaseStore, the package's name and directory are computed,
-    pkg.Filename is set and the file is physically copied into the
-    repository.
+    pkg.Filename is set and the file is placed into the repository by
+    the first applicable method of config.placement, see placeFile.
+    If the package has been downloaded into a spool directory inside
+    the repository (see pkg.spoolfile), the download is moved into place
+    instead. The method used is stored in pkg.placement.
+
+  binDelLastRef(self, ref) : optional
+    Remove the package file of the last reference to a package that
+    has been replaced by a different one in the database. Only called if no other
+    release, snapshots included, refers to the package, otherwise
+    binDelRef is called with all its references.
+
+    In the BaseStore the file is removed, together with now empty
+    directories.
 
   binAddRef(self, pkg, component, release) : mandatory
     Add a new reference to the package. Will only be called if the
     package is already present in the repository and only a new
-    reference to it is added. pkg.Filename must be set as in
-    binNewPkg
+    reference to it is added, after that reference has been added to
+    the database. pkg.Filename must be set as in binNewPkg
 
   binDelRef(self, refs) : mandatory
     Delete a reference. A list of BinPkgRef objects is passed to the
@@ -42,27 +56,239 @@ A store implements the following methods:
     reference to the package is deleted, which usually means, the
     file is removed
 
+  binAddRefs(self, refs, release) : optional
+    Add references to packages already present in the repository to
+    the given release in bulk, e.g. when cloning a release. A list of
+    BinPkgRef objects of existing references is passed, the new
+    references get the same components. Must set the newFilename
+    attribute of each reference.
+
+    In the BaseStore, newFilename is set to Filename.
+
+  binMoveNames(self, moves) : optional
+    Name the files of references to be moved to another release and/or
+    component, without touching them. A list of BinPkgRef objects is
+    passed, each with the name of its new release in newCodename and its
+    new component in newcomp. Must set the newFilename attribute of each
+    reference.
+
+    In the BaseStore newFilename is set to Filename, as the pool layout
+    does not depend on the release.
+
+  binMoveRefs(self, moves) : optional
+    Move the files of references named by binMoveNames. Called after
+    the database has been changed, which is rolled back if this fails,
+    so files already moved must be moved back then.
+
+    In the BaseStore files are not moved.
+
+  srcPrepareAdd(self, src, component, release) : optional
+    Prepare adding a new source package. Must set src.Directory, the
+    directory holding all files of the package, relative to the
+    repository root.
+
+    In the BaseStore, the directory is computed by pkgDir and created.
+
+  srcAddFile(self, src, name) : optional
+    Place the file name of the source package, found next to its .dsc,
+    into src.Directory and return the method used. Only called for
+    files not yet present there, files shared with other source
+    packages are placed once.
+
+    In the BaseStore, the file is placed like a binary package by
+    placeFile.
+
+  srcDelFiles(self, paths) : optional
+    Remove files of source packages no longer used by any package.
+    paths are relative to the repository root.
+
+    In the BaseStore, the files are removed, together with now empty
+    directories.
+
+  storedFiles(self) : optional
+    Iterate over the names of all package files in the store, relative
+    to the repository root. Used to find files no database entry
+    refers to.
+
+    In the BaseStore, all files below pool are listed.
+
+  checkRefs(self, refs) : optional
+    Check the files of all references to a single package, given as a
+    list of BinPkgRef objects, and return a list of problems found.
+
+    In the BaseStore nothing is checked, as all references share one
+    file.
+
+A store also has the class attribute snapshots, which is True if the
+package files do not depend on the release, so a snapshot of a release
+can simply share all references with it. It is True in the BaseStore.
+
 """
+import errno
+import fcntl
 import logging
 import os
 import os.path
 import shutil
 
+from error import ConfigError
+
 logger = logging.getLogger(__name__)
 
+# ioctl to share the data blocks of a file on a copy-on-write filesystem
+_FICLONE = 0x40049409
+
+# errors meaning a placement method is not possible for a file
+_unsupported = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+	errno.EINVAL, errno.ENOSYS, errno.EMLINK)
+
+def _mustNotExist(path):
+	"""Raise FileExistsError if path exists, even as a dangling symlink"""
+	if os.path.lexists(path):
+		raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+
 class BaseStore:
 
+	placements = ('reflink', 'hardlink', 'move', 'copy')
+	snapshots = True
+
 	def __init__(self, config):
 		self.root = config.root
+		self.placement = config.placement
+		if isinstance(self.placement, str):
+			self.placement = [self.placement]
+		for method in self.placement:
+			if method not in self.placements:
+				raise ConfigError("Unknown placement '{}'".format(method))
 
 	def binNewPkg(self, pkg, component, release):
 		self.binPrepareAdd(pkg, component, release)
-		# copy file
-		shutil.copy(pkg.origfile, os.path.join(self.root, pkg.Filename))
+		dst = os.path.join(self.root, pkg.Filename)
+		if getattr(pkg, 'spoolfile', None) is not None:
+			# package has been downloaded into the repository, move it
+			_mustNotExist(dst)
+			os.replace(pkg.spoolfile, dst)
+			pkg.spoolfile = None
+			pkg.placement = 'spool'
+		else:
+			pkg.placement = self.placeFile(pkg.origfile, dst)
+		logger.info("Placed %s by %s", pkg.Filename, pkg.placement)
+
+	def binDelLastRef(self, ref):
+		self.binDelCleanup(os.path.join(self.root, ref.Filename))
+
+	def binAddRefs(self, refs, release):
+		for ref in refs:
+			ref.newFilename = ref.Filename
+
+	def binMoveNames(self, moves):
+		for ref in moves:
+			ref.newFilename = ref.Filename
+
+	def binMoveRefs(self, moves):
+		pass
+
+
+	def srcPrepareAdd(self, src, component, release):
+		src.Directory = self.pkgDir(src, component, release)
+		os.makedirs(os.path.join(self.root, src.Directory), exist_ok=True)
+
+	def srcAddFile(self, src, name):
+		return self.placeFile(
+			os.path.join(os.path.dirname(src.origfile), name),
+			os.path.join(self.root, src.Directory, name))
+
+	def srcDelFiles(self, paths):
+		for path in paths:
+			self.binDelCleanup(os.path.join(self.root, path))
+
+
+	def storedFiles(self):
+		pool = os.path.join(self.root, 'pool')
+		for dirpath, _, filenames in os.walk(pool):
+			for name in filenames:
+				yield os.path.relpath(os.path.join(dirpath, name), self.root)
+
+	def checkRefs(self, refs):
+		return []
 
 
 	# Helper methods useful for all child classes
 
+	def placeFile(self, src, dst):
+		"""
+		Place the file src at dst, which must not exist
+
+		The methods in self.placement are tried in order, until one
+		succeeds, and the name of that method is returned. copy always
+		succeeds, and is used when all others fail. reflink shares the
+		data blocks on filesystems supporting it, hardlink and move need
+		src and dst on the same filesystem. A move across filesystems
+		copies the file and removes src. An existing dst, e.g. the file of
+		another package of the same name, is never touched.
+		"""
+		# rename would replace dst silently
+		_mustNotExist(dst)
+		for method in self.placement:
+			try:
+				if method == 'reflink':
+					with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+						try:
+							fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+						except OSError:
+							# dst has been created right now
+							fdst.close()
+							os.remove(dst)
+							raise
+					shutil.copymode(src, dst)
+					return method
+				if method == 'hardlink':
+					os.link(src, dst)
+					return method
+				if method == 'move':
+					try:
+						os.rename(src, dst)
+					except OSError as e:
+						if e.errno != errno.EXDEV: raise
+						self.copyFile(src, dst)
+						os.remove(src)
+					return method
+				if method == 'copy':
+					break
+			except OSError as e:
+				if e.errno not in _unsupported: raise
+				logger.debug("Cannot place %s by %s: %s", dst, method, e)
+		return self.copyFile(src, dst)
+
+	@staticmethod
+	def copyFile(src, dst):
+		"""
+		Copy src to dst within the kernel, return the method used
+
+		dst must not exist, it is removed again if copying fails.
+		copy_file_range is used if possible, otherwise shutil.copyfile,
+		which uses sendfile where available.
+		"""
+		with open(src, 'rb') as fsrc:
+			fdst = open(dst, 'xb')
+			try:
+				try:
+					with fdst:
+						while os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+								1 << 30) > 0:
+							pass
+					method = 'copy_file_range'
+				except OSError as e:
+					if e.errno not in _unsupported: raise
+					# dst has been created right now, so it may be replaced
+					shutil.copyfile(src, dst)
+					method = 'sendfile'
+				shutil.copymode(src, dst)
+			except:
+				os.remove(dst)
+				raise
+		return method
+
 	def pkgFilename(self, pkg):
 		"""Filename for the package"""
 		# Get version without a possible epoch
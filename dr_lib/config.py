@@ -11,13 +11,33 @@ from error import ConfigError
 logger = logging.getLogger(__name__)
 
 _top_options = {
+	'addworkers': 1,
+	'byhash': False,
+	'byhashkeep': 3,
+	'contents': False,
 	'db': None,
 	'dbtype': 'sqlite',
 	'defarchitectures': set(['all', 'amd64', 'i386']),
 	'defcomponents': [ 'main' ],
 	'defcomponentrules': None,
 	'defrelease': None,
+	'debounce': 2.0,
 	'defgpgkey': None,
+	'fetchworkers': 4,
+	'fsckworkers': 4,
+	'gpghome': None,
+	'indexcompressors': ['none', 'gz', 'xz'],
+	'indexcompresslevels': None,
+	'indexworkers': 1,
+	'indexpool': 'thread',
+	'loglevel': 'info',
+	'pdiffs': False,
+	'pdiffkeep': 14,
+	'placement': ['copy'],
+	'signer': 'gpg',
+	'signworkers': 4,
+	'socket': None,
+	'stagedpublish': False,
 	'store': 'pool',
 	'root': None,
 	'releases': None
@@ -33,7 +53,12 @@ _release_options = {
 	'componentrules': None,
 	'architectures': None,
 	'readonly': False,
-	'gpgkey': None
+	'gpgkey': None,
+	'byhash': None,
+	'contents': None,
+	'pdiffs': None,
+	'indexcompressors': None,
+	'indexcompresslevels': None
 }
 
 def _del_unknowns(orig, proto):
@@ -59,8 +84,14 @@ def getConfig(args):
 		# merge in default values
 		for k, v in _top_options.items():
 			if not hasattr(cfg, k): setattr(cfg, k, v)
-		if cfg.dbtype == 'sqlite' and cfg.db is None:
-			cfg.db = {'database':	os.path.join(cfg.root, 'db', 'repo.db')}
+		if cfg.dbtype == 'sqlite':
+			if cfg.db is None: cfg.db = {}
+			if 'database' not in cfg.db:
+				cfg.db['database'] = os.path.join(cfg.root, 'db', 'repo.db')
+		if cfg.socket is None:
+			cfg.socket = os.path.join(cfg.root, 'db', 'debrep.sock')
+		if cfg.loglevel not in ('debug', 'info', 'warning', 'error'):
+			raise ConfigError("Unknown loglevel '{}'".format(cfg.loglevel))
 
 	def set_release_defaults(rel):
 		# merge in default values
@@ -73,6 +104,16 @@ def getConfig(args):
 			rel.components = top.defcomponents
 		if rel.gpgkey is None:
 			rel.gpgkey = top.defgpgkey
+		if rel.byhash is None:
+			rel.byhash = top.byhash
+		if rel.contents is None:
+			rel.contents = top.contents
+		if rel.pdiffs is None:
+			rel.pdiffs = top.pdiffs
+		if rel.indexcompressors is None:
+			rel.indexcompressors = top.indexcompressors
+		if rel.indexcompresslevels is None:
+			rel.indexcompresslevels = top.indexcompresslevels
 
 	def local_defaults(cfg):
 		if not hasattr(cfg, 'root'):
@@ -152,6 +193,18 @@ class Config(types.SimpleNamespace):
 		self._store = store.Store(self)
 		return self._store
 
+	def getSigner(self):
+		if '_signer' in self.__dict__: return self._signer
+		if self.signer not in ('gpg', 'none'):
+			raise ConfigError("Unknown signer '{}'".format(self.signer))
+		signer = importlib.import_module('signer.' + self.signer)
+		self._signer = signer.Signer(self)
+		return self._signer
+
+	def needFiles(self):
+		"""True if the file lists of packages are needed"""
+		return any(r.contents for r in self.releases.values())
+
 	def getPkgComponent(self, name, release):
 		"""Get configured component of a package
 
@@ -0,0 +1,152 @@
+--
+-- Hold binary packages metadata. Each package file in the repository will get
+-- exactly one id. If the same package is present in several releases, it will
+-- still have only one id, but several references (see below)
+--
+CREATE TABLE binpackages (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT,
+	udeb INTEGER,         -- 1 if the package is a udeb, 0 otherwise
+	control TEXT,         -- Content of the binary package control file
+	Version TEXT,
+	Architecture TEXT,
+	Size INTEGER,         -- Size of package file in bytes
+	MD5Sum TEXT,
+	SHA1 TEXT,
+	SHA256 TEXT,
+	Description_md5 TEXT,
+	stanza TEXT           -- Fields added to control in a Packages index,
+	                      -- except Filename (see Db.stanzaExpr)
+);
+CREATE INDEX bpname ON binpackages (name, Architecture);
+
+--
+-- Full text search over binary packages, rowid is binpackages.id.
+-- The trigram tokenizer allows searching for arbitrary substrings.
+--
+CREATE VIRTUAL TABLE binsearch USING fts5 (
+	name, Description, Provides, Section, Maintainer,
+	tokenize='trigram'
+);
+
+--
+-- File lists of binary packages for the Contents indices, stored as zlib
+-- compressed, newline separated file names. Section is the section of the
+-- package as needed for the location in Contents files.
+--
+CREATE TABLE bincontents (
+	id INTEGER PRIMARY KEY,  -- id of package (=> binpackages.id)
+	Section TEXT,
+	files BLOB
+);
+
+--
+-- Hold source packages metadata, like binpackages. The files of a source
+-- package are held in srcfiles.
+--
+CREATE TABLE srcpackages (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT,
+	dsc TEXT,             -- Content of the dsc File
+	Priority TEXT,
+	Section TEXT,
+	Version TEXT,
+	SHA256 TEXT,          -- SHA256 sum of the dsc file
+	stanza TEXT           -- Stanza in a Sources index, except Directory
+);
+CREATE INDEX spname ON srcpackages (name);
+
+--
+-- Files of source packages, the dsc files included. Each file is stored
+-- once, no matter how many source packages share it, as e.g. the orig
+-- tarball of consecutive debian revisions. refs is the number of source
+-- packages using the file.
+--
+CREATE TABLE srcfiles (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	path TEXT,            -- File name relative to repository root
+	Size INTEGER,
+	MD5Sum TEXT,
+	SHA1 TEXT,
+	SHA256 TEXT,
+	refs INTEGER
+);
+CREATE UNIQUE INDEX sfpath ON srcfiles (path);
+
+CREATE TABLE src_files (
+	idsrc INTEGER,        -- id of source package (=> srcpackages.id)
+	idfile INTEGER,       -- id of file (=> srcfiles.id)
+	PRIMARY KEY (idsrc, idfile)
+);
+
+CREATE TABLE releases (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	Codename TEXT,
+	snapshotof INTEGER,   -- For snapshots, the release (=> releases.id)
+	                      -- the snapshot was taken from, otherwise NULL
+	created TEXT          -- For snapshots, the time it was taken (UTC)
+);
+CREATE UNIQUE INDEX relcodename ON releases (Codename);
+
+--
+-- Hold the binary packages of releases
+-- Each release contains a certain number of pacakges, and
+-- for each package there is a release specific component and file
+-- name (relative to the repository root). The file name of a package
+-- with a given id may or may differ between releases. For a package
+-- pool it will always be the same but we want to support various
+-- repository layouts.
+--
+CREATE TABLE release_bin (
+	idrel INTEGER,        -- id of release (=> releases.id)
+	idpkg INTEGER,        -- id of package (=> binpackages.id)
+	component TEXT,
+	Filename TEXT,        -- Package filename relative to repository root
+	PRIMARY KEY (idrel, idpkg)
+);
+CREATE INDEX rbpr ON release_bin (idpkg, idrel);
+
+--
+-- Hold the source packages of releases, like release_bin. Directory is
+-- the directory holding all files of the package, relative to the
+-- repository root.
+--
+CREATE TABLE release_src (
+	idrel INTEGER,        -- id of release (=> releases.id)
+	idsrc INTEGER,        -- id of source package (=> srcpackages.id)
+	component TEXT,
+	Directory TEXT,
+	PRIMARY KEY (idrel, idsrc)
+);
+CREATE INDEX rspr ON release_src (idsrc, idrel);
+
+--
+-- History of index files published by hash (Acquire-By-Hash). For each
+-- index file, relative to dists/<release>, the SHA256 sums of its recent
+-- contents. The highest generation is the current content.
+--
+CREATE TABLE byhash (
+	idrel INTEGER,
+	file TEXT,
+	SHA256 TEXT,
+	generation INTEGER,
+	PRIMARY KEY (idrel, file, SHA256)
+);
+
+--
+-- Files verified by debrep fsck. A file whose inode, size and modification
+-- time (in ns) are unchanged need not be hashed again.
+--
+CREATE TABLE statcache (
+	path TEXT PRIMARY KEY, -- File name relative to repository root
+	inode INTEGER,
+	size INTEGER,
+	mtime INTEGER,
+	SHA256 TEXT
+);
+
+CREATE TABLE dbschema (
+	version INTEGER
+);
+
+INSERT INTO dbschema VALUES (8);
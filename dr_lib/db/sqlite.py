@@ -4,14 +4,21 @@ Debrep module implementing sqlite3 as db backend
 """
 
 import collections
+import contextlib
+import fcntl
 import logging
 import os
 import os.path
 import sqlite3
+import urllib.parse
+import zlib
 
 
 from debian.deb822 import Deb822
-from package import BinPkgRef
+from error import DbError
+from utils import Hashes
+from package import BinPkgRef, SrcPkgRef
+import timing
 
 logger = logging.getLogger(__name__)
 
@@ -78,9 +85,36 @@ def makeQuery(arch, component, idrel, name):
 	return sqlj, sqlw, sqlparams
 
 
+def stanzaExpr(prefix=''):
+	"""
+	SQL expression rendering the fields a Packages index adds to the
+	control file of a package, except the release specific Filename.
+
+	prefix is prepended to the column names, use ':' to render from
+	named parameters instead of columns.
+	"""
+	fields = ('Size', 'MD5Sum', 'SHA1', 'SHA256', 'Description_md5')
+	return ' || '.join("'{0}: ' || {1}{0} || char(10)".format(f, prefix)
+		for f in fields) + ' || char(10)'
+
+
+def matchExpr(terms, names=False):
+	"""
+	Create a full text search expression from search terms
+
+	Each term is quoted, so it is searched for literally. All terms
+	must match. If names is set, only package names are searched.
+	"""
+	expr = ' '.join('"' + t.replace('"', '""') + '"' for t in terms)
+	return 'name : (' + expr + ')' if names else expr
+
+
 class Db:
 
-	version = 1
+	version = 8
+
+	# Control fields in the full text search table besides the name
+	searchFields = ('Description', 'Provides', 'Section', 'Maintainer')
 
 	def mktables(self):
 		logger.info('Create new db')
@@ -102,10 +136,15 @@ class Db:
 		a warning, but leave it to the user to actually delete it.
 		"""
 		# First get all releases from the database and set id in config
-		self.dbc.execute('SELECT id,Codename FROM releases')
+		self.dbc.execute('SELECT id,Codename,snapshotof FROM releases')
 		for row in self.dbc.fetchall():
-			id, name = row
-			if name in releases:
+			id, name, snapshotof = row
+			if snapshotof is not None:
+				# Snapshots are not configured
+				if name in releases:
+					raise DbError("Release %s is a snapshot in the "
+						"database" % name)
+			elif name in releases:
 				releases[name].id = id
 			else:
 				logger.warning("Relase with codename %s exists in the "
@@ -136,16 +175,226 @@ class Db:
 		self.dbc.execute("SELECT version FROM dbschema")
 		dbv = self.dbc.fetchone()[0]
 		logger.debug('Opened db version %d', dbv)
+		while dbv < self.version:
+			dbv += 1
+			logger.info('Upgrade db to version %d', dbv)
+			getattr(self, 'upgrade{:03d}'.format(dbv))()
+			self.dbc.execute("UPDATE dbschema SET version=?", (dbv,))
+			self.db.commit()
+
+	def upgrade002(self):
+		"""Add the pre-rendered index stanza"""
+		self.dbc.execute("ALTER TABLE binpackages ADD COLUMN stanza TEXT")
+		self.dbc.execute("UPDATE binpackages SET stanza=" + stanzaExpr())
 
-	def __init__(self, config):
-		dbfile = config.db['database']
-		if not os.path.exists(dbfile):
+	def upgrade003(self):
+		"""Add the full text search table and fill it"""
+		self.dbc.execute("""CREATE VIRTUAL TABLE binsearch USING fts5 (
+			name, Description, Provides, Section, Maintainer,
+			tokenize='trigram')""")
+		c = self.db.cursor()
+		c.execute("SELECT id, name, control FROM binpackages")
+		for id, name, control in c:
+			self.searchAdd(id, name, Deb822(control))
+		c.close()
+
+	def upgrade004(self):
+		"""Add the file lists of packages, filled when needed"""
+		self.dbc.execute("""CREATE TABLE bincontents (
+			id INTEGER PRIMARY KEY, Section TEXT, files BLOB)""")
+
+	def upgrade005(self):
+		"""Add the history of indices published by hash"""
+		self.dbc.execute("""CREATE TABLE byhash (
+			idrel INTEGER, file TEXT, SHA256 TEXT, generation INTEGER,
+			PRIMARY KEY (idrel, file, SHA256))""")
+
+	def upgrade006(self):
+		"""Allow releases to be snapshots"""
+		self.dbc.execute("ALTER TABLE releases ADD COLUMN snapshotof INTEGER")
+		self.dbc.execute("ALTER TABLE releases ADD COLUMN created TEXT")
+
+	def upgrade007(self):
+		"""Add the files of source packages"""
+		for col in ('Version', 'SHA256', 'stanza'):
+			self.dbc.execute(
+				"ALTER TABLE srcpackages ADD COLUMN {} TEXT".format(col))
+		self.dbc.execute("CREATE INDEX spname ON srcpackages (name)")
+		self.dbc.execute("""CREATE TABLE srcfiles (
+			id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, Size INTEGER,
+			MD5Sum TEXT, SHA1 TEXT, SHA256 TEXT, refs INTEGER)""")
+		self.dbc.execute("CREATE UNIQUE INDEX sfpath ON srcfiles (path)")
+		self.dbc.execute("""CREATE TABLE src_files (
+			idsrc INTEGER, idfile INTEGER, PRIMARY KEY (idsrc, idfile))""")
+		self.dbc.execute("CREATE INDEX rspr ON release_src (idsrc, idrel)")
+
+	def upgrade008(self):
+		"""Add the stat cache of fsck"""
+		self.dbc.execute("""CREATE TABLE statcache (
+			path TEXT PRIMARY KEY, inode INTEGER, size INTEGER,
+			mtime INTEGER, SHA256 TEXT)""")
+
+	def __init__(self, config, readonly=False):
+		"""
+		Open the database given by config.db
+
+		With readonly set, an existing database is opened for queries
+		only, e.g. by index workers running alongside the main
+		connection. It is neither created nor synchronized with the
+		releases from the config.
+		"""
+		dbargs = dict(config.db)
+		pragmas = dbargs.pop('pragmas', None) or {}
+		self.batchsize = dbargs.pop('batchsize', 100)
+		self.pending = 0
+		dbfile = dbargs['database']
+		# see lock()
+		self.lockfile = os.path.join(os.path.dirname(os.path.abspath(dbfile)),
+			'lock')
+		self.lockfd = None
+		if readonly:
+			dbargs['database'] = 'file:{}?mode=ro'.format(
+				urllib.parse.quote(dbfile))
+			dbargs['uri'] = True
+		elif not os.path.exists(dbfile):
 			os.makedirs(os.path.dirname(dbfile), exist_ok=True)
-		self.db = sqlite3.connect(**config.db)
+		self.db = sqlite3.connect(**dbargs)
 		self.db.row_factory = sqlite3.Row
 		self.dbc = self.db.cursor()
+		self.setPragmas(pragmas, readonly)
+		if readonly: return
 		self.initdb()
-		self.syncreleases(config.releases)
+		with timing.phase('db syncreleases'):
+			self.syncreleases(config.releases)
+
+	def setPragmas(self, pragmas, readonly=False):
+		"""
+		Apply the pragmas given in the db section of the config
+
+		The journal mode is a property of the database file, so it is
+		only set by connections that may write to it.
+		"""
+		for name, value in pragmas.items():
+			if not name.isidentifier():
+				raise DbError("Invalid pragma '{}'".format(name))
+			if readonly and name == 'journal_mode': continue
+			if isinstance(value, bool): value = int(value)
+			self.dbc.execute('PRAGMA {}={}'.format(name, value))
+			logger.debug('Set pragma %s=%s', name, value)
+
+	@contextlib.contextmanager
+	def pkgTransaction(self):
+		"""
+		Context for all db changes made for a single package
+
+		The changes are done within a savepoint, so a failure only rolls
+		back the changes belonging to that package. The transaction is
+		committed every batchsize packages. The repository is locked with
+		the first change, see lock().
+		"""
+		self.lock()
+		if not self.db.in_transaction:
+			self.dbc.execute('BEGIN')
+		self.dbc.execute('SAVEPOINT pkg')
+		try:
+			yield
+		except:
+			self.dbc.execute('ROLLBACK TO pkg')
+			self.dbc.execute('RELEASE pkg')
+			raise
+		self.dbc.execute('RELEASE pkg')
+		self.pending += 1
+		if self.pending >= self.batchsize:
+			self.commit()
+
+	def searchAdd(self, id, name, cdict):
+		"""Add a package to the full text search table"""
+		self.dbc.execute(
+			"""INSERT INTO binsearch
+				(rowid, name, Description, Provides, Section, Maintainer)
+			VALUES (?, ?, ?, ?, ?, ?)""",
+			[id, name] + [cdict.get(f, '') for f in self.searchFields])
+
+	def searchDel(self, id):
+		"""Remove a package from the full text search table"""
+		self.dbc.execute("DELETE FROM binsearch WHERE rowid=?", (id,))
+
+	def contentsSet(self, id, section, files):
+		"""Store the list of files of a package"""
+		self.dbc.execute(
+			"INSERT OR REPLACE INTO bincontents VALUES (?, ?, ?)",
+			(id, section, zlib.compress('\n'.join(files).encode())))
+
+	def contentsMissing(self, idrel):
+		"""
+		Packages in a release without a list of files
+
+		Return a list of (id, Filename, control) tuples
+		"""
+		self.dbc.execute(
+			"""SELECT b.id, r.Filename, b.control
+			FROM release_bin r
+			JOIN binpackages b ON r.idpkg=b.id
+			LEFT JOIN bincontents c ON b.id=c.id
+			WHERE r.idrel=? AND c.id IS NULL""", (idrel,))
+		return [tuple(r) for r in self.dbc.fetchall()]
+
+	def getContents(self, arch, component, idrel):
+		"""
+		Return an iterator over the file lists of all packages in an
+		arch,comp,release triple
+
+		Each item is a tuple with the location of the package, i.e.
+		section/name as used in Contents indices, and its list of files.
+		"""
+		c = self.db.cursor()
+		c.row_factory = None
+		c.execute(
+			"""SELECT b.name, c.Section, c.files
+			FROM release_bin r
+			JOIN binpackages b ON r.idpkg=b.id
+			JOIN bincontents c ON b.id=c.id
+			WHERE r.idrel=? AND r.component=? AND b.Architecture=?""",
+			(idrel, component, arch))
+		for name, section, files in c:
+			location = section + '/' + name if section else name
+			files = zlib.decompress(files).decode()
+			yield location, files.split('\n') if files else []
+		c.close()
+
+	def byhashAdd(self, idrel, file, digest, keep):
+		"""
+		Record digest as the current content of an index file
+
+		Only the keep most recent contents of each index file are kept.
+		Return the digests dropped from the history that are not in use
+		by any other index in the same directory, i.e. whose by-hash
+		files can be removed.
+		"""
+		self.dbc.execute(
+			"""SELECT SHA256, generation FROM byhash
+			WHERE idrel=? AND file=? ORDER BY generation DESC""",
+			(idrel, file))
+		history = [tuple(r) for r in self.dbc.fetchall()]
+		if len(history) > 0 and history[0][0] == digest:
+			return []
+		generation = history[0][1] + 1 if len(history) > 0 else 1
+		self.dbc.execute(
+			"INSERT OR REPLACE INTO byhash VALUES (?, ?, ?, ?)",
+			(idrel, file, digest, generation))
+		dropped = [d for d, _ in history if d != digest][keep - 1:]
+		result = []
+		for d in dropped:
+			self.dbc.execute(
+				"DELETE FROM byhash WHERE idrel=? AND file=? AND SHA256=?",
+				(idrel, file, d))
+			self.dbc.execute(
+				"SELECT file FROM byhash WHERE idrel=? AND SHA256=?",
+				(idrel, d))
+			if all(os.path.dirname(r[0]) != os.path.dirname(file)
+					for r in self.dbc.fetchall()):
+				result.append(d)
+		return result
 
 	def newBinary(self, pkg):
 		"""
@@ -156,13 +405,16 @@ class Db:
 		"""
 		sql = """INSERT INTO binpackages (
 			name, control, Version, Architecture, udeb,
-			Size, MD5Sum, SHA1, SHA256, Description_md5)
+			Size, MD5Sum, SHA1, SHA256, Description_md5, stanza)
 		VALUES (
 			:name, :control, :Version, :Architecture, :udeb,
-			:Size, :MD5Sum, :SHA1, :SHA256, :Description_md5)
-		"""
+			:Size, :MD5Sum, :SHA1, :SHA256, :Description_md5, {})
+		""".format(stanzaExpr(':'))
 		self.dbc.execute(sql, pkg.__dict__);
 		pkg.id = self.dbc.lastrowid
+		self.searchAdd(pkg.id, pkg.name, pkg.cdict)
+		if getattr(pkg, 'files', None) is not None:
+			self.contentsSet(pkg.id, pkg.cdict.get('Section'), pkg.files)
 		logger.info("New binary package %s_%s_%s with id %d",
 			pkg.name, pkg.Version, pkg.Architecture, pkg.id)
 
@@ -175,10 +427,16 @@ class Db:
 		sql = """UPDATE binpackages
 		SET name=:name, control=:control, Version=:Version,
 			Architecture=:Architecture, Size=:Size, MD5Sum=:MD5Sum,
-			SHA1=:SHA1, SHA256=:SHA256, Description_md5=:Description_md5
+			SHA1=:SHA1, SHA256=:SHA256, Description_md5=:Description_md5,
+			stanza={}
 		WHERE id=:id
-		"""
+		""".format(stanzaExpr(':'))
 		self.dbc.execute(sql, pkg.__dict__);
+		self.searchDel(pkg.id)
+		self.searchAdd(pkg.id, pkg.name, pkg.cdict)
+		self.dbc.execute("DELETE FROM bincontents WHERE id=?", (pkg.id,))
+		if getattr(pkg, 'files', None) is not None:
+			self.contentsSet(pkg.id, pkg.cdict.get('Section'), pkg.files)
 		sql = """UPDATE release_bin SET Filename=?, component=?
 		WHERE idrel=? AND idpkg=?
 		"""
@@ -194,6 +452,15 @@ class Db:
 		r = self.dbc.fetchone()
 		return dict(zip(r.keys(), r))
 
+	def binSums(self):
+		"""The set of the SHA256 sums of all binary packages"""
+		c = self.db.cursor()
+		c.row_factory = None
+		c.execute("SELECT SHA256 FROM binpackages")
+		result = set(r[0] for r in c)
+		c.close()
+		return result
+
 	def binGetRefs(self, pkgid):
 		"""
 		Get all references to a binary package
@@ -237,6 +504,9 @@ class Db:
 			# Safety check in case the ref has been deleted in the meantime
 			if result[0].id == pkgid and result[0].idrel == relid:
 				self.dbc.execute("DELETE from binpackages WHERE id=?", (pkgid,))
+				self.searchDel(pkgid)
+				self.dbc.execute("DELETE FROM bincontents WHERE id=?",
+					(pkgid,))
 				logger.debug("Last reference to %s deleted",
 					result[0].Filename)
 				result[0].deleted = True
@@ -258,6 +528,167 @@ class Db:
 			result[0].deleted = False
 		return result
 
+	def newSource(self, src):
+		"""
+		Create a new entry for a source package and its files
+
+		src.Directory is the directory of the files. Files already
+		present there are shared, i.e. their reference count is
+		increased. Hashes of all other files must be complete.
+		"""
+		self.dbc.execute("""INSERT INTO srcpackages
+			(name, dsc, Priority, Section, Version, SHA256, stanza)
+			VALUES (?, ?, ?, ?, ?, ?, ?)""", (src.name, src.dsc,
+			src.Priority, src.Section, src.Version, src.SHA256, src.stanza()))
+		src.id = self.dbc.lastrowid
+		for name, hashes in src.files.items():
+			path = os.path.join(src.Directory, name)
+			self.dbc.execute("""INSERT INTO srcfiles
+				(path, Size, MD5Sum, SHA1, SHA256, refs)
+				VALUES (?, ?, ?, ?, ?, 0)
+				ON CONFLICT (path) DO NOTHING""", (path,) + tuple(hashes))
+			self.dbc.execute(
+				"UPDATE srcfiles SET refs=refs+1 WHERE path=? RETURNING id",
+				(path,))
+			self.dbc.execute("INSERT INTO src_files VALUES (?, ?)",
+				(src.id, self.dbc.fetchone()[0]))
+		logger.info("New source package %s_%s with id %d",
+			src.name, src.Version, src.id)
+
+	def srcFile(self, path):
+		"""Hashes of a source package file, None if it is not present"""
+		self.dbc.execute(
+			"SELECT Size, MD5Sum, SHA1, SHA256 FROM srcfiles WHERE path=?",
+			(path,))
+		row = self.dbc.fetchone()
+		return None if row is None else Hashes(str(row[0]), *row[1:])
+
+	def srcGetRefsAdd(self, src, tid):
+		"""
+		Get all references needed when adding a source package to a
+		target release, like getrefsAdd
+
+		Those are references to a package with the same name in the
+		target release and to packages of the same name and version in
+		other releases. A reference in the target comes first.
+		"""
+		self.dbc.execute(
+			"""SELECT s.id, r.idrel, rl.Codename, r.component, r.Directory,
+				s.name, s.Version, s.SHA256
+			FROM srcpackages s
+			JOIN release_src r ON s.id = r.idsrc
+			JOIN releases rl ON r.idrel = rl.id
+			WHERE s.name=:name AND (r.idrel=:tid OR s.Version=:version)
+			ORDER BY r.idrel<>:tid""",
+			dict(name=src.name, tid=tid, version=src.Version))
+		return [SrcPkgRef(**dict(zip(row.keys(), row)))
+			for row in self.dbc.fetchall()]
+
+	def addSourceRef(self, idrel, idsrc, component, directory):
+		self.dbc.execute(
+			"""INSERT OR IGNORE INTO release_src
+			   (idrel, idsrc, component, Directory)
+			VALUES (?, ?, ?, ?)""", (idrel, idsrc, component, directory))
+
+	def srcDelRef(self, idsrc, idrel):
+		"""
+		Delete a source package from a release
+
+		If that was the last reference to the package, the package is
+		deleted and the reference counts of its files are decreased.
+		Return the reference deleted, None if there was none, and the
+		list of files no longer used by any package. Those are deleted
+		from the database, but must still be removed from the store.
+		"""
+		self.dbc.execute(
+			"""SELECT s.id, r.idrel, rl.Codename, r.component, r.Directory,
+				s.name, s.Version, s.SHA256
+			FROM srcpackages s
+			JOIN release_src r ON s.id = r.idsrc
+			JOIN releases rl ON r.idrel = rl.id
+			WHERE s.id=? AND r.idrel=?""", (idsrc, idrel))
+		row = self.dbc.fetchone()
+		if row is None: return None, []
+		ref = SrcPkgRef(**dict(zip(row.keys(), row)))
+		self.dbc.execute("DELETE FROM release_src WHERE idrel=? AND idsrc=?",
+			(idrel, idsrc))
+		self.dbc.execute("SELECT 1 FROM release_src WHERE idsrc=? LIMIT 1",
+			(idsrc,))
+		if self.dbc.fetchone() is not None: return ref, []
+		logger.debug("Last reference to %s deleted", ref)
+		self.dbc.execute("DELETE FROM srcpackages WHERE id=?", (idsrc,))
+		self.dbc.execute("""UPDATE srcfiles SET refs=refs-1
+			WHERE id IN (SELECT idfile FROM src_files WHERE idsrc=?)""",
+			(idsrc,))
+		self.dbc.execute("DELETE FROM src_files WHERE idsrc=?", (idsrc,))
+		self.dbc.execute("DELETE FROM srcfiles WHERE refs<=0 RETURNING path")
+		return ref, [r[0] for r in self.dbc.fetchall()]
+
+	def listSrcIds(self, component, idrel, name):
+		"""List source package ids for given properties, like listIds"""
+		sqlparams = []
+		cond = []
+		condParaAdd(cond, sqlparams, 'r.component', component)
+		condParaAdd(cond, sqlparams, 'r.idrel', idrel)
+		condParaAddStr(cond, sqlparams, 's.name', name)
+		sql = """SELECT DISTINCT s.id FROM srcpackages s
+			JOIN release_src r ON s.id=r.idsrc"""
+		if len(cond) > 0:
+			sql += ' WHERE ' + ' AND '.join(cond)
+		self.dbc.execute(sql, sqlparams)
+		return [row[0] for row in self.dbc.fetchall()]
+
+	def binAllRefs(self):
+		"""
+		Iterate over the references of all binary packages
+
+		Yield one list of BinPkgRef objects per package, which also hold
+		the Size of the package
+		"""
+		c = self.db.cursor()
+		c.execute(
+			"""SELECT p.id, r.idrel, rl.Codename, r.component, r.Filename,
+				p.name, p.Version, p.Architecture, p.SHA256, p.Size
+			FROM binpackages p
+			JOIN release_bin r ON p.id = r.idpkg
+			JOIN releases rl ON r.idrel = rl.id
+			ORDER BY p.id""")
+		refs = []
+		for row in c:
+			ref = BinPkgRef(**dict(zip(row.keys(), row)))
+			if len(refs) > 0 and refs[0].id != ref.id:
+				yield refs
+				refs = []
+			refs.append(ref)
+		if len(refs) > 0: yield refs
+		c.close()
+
+	def srcAllFiles(self):
+		"""Return a list of (path, Size, SHA256) of all source files"""
+		self.dbc.execute("SELECT path, Size, SHA256 FROM srcfiles")
+		return [tuple(r) for r in self.dbc.fetchall()]
+
+	def statCache(self):
+		"""Map the paths in the stat cache to (inode, size, mtime, SHA256)"""
+		c = self.db.cursor()
+		c.row_factory = None
+		c.execute("SELECT path, inode, size, mtime, SHA256 FROM statcache")
+		result = dict((r[0], r[1:]) for r in c)
+		c.close()
+		return result
+
+	def statCacheUpdate(self, entries):
+		"""
+		Record verified files
+
+		entries is an iterable of (path, inode, size, mtime, SHA256)
+		tuples. Entries of files no longer in the repository are dropped.
+		"""
+		self.dbc.executemany(
+			"INSERT OR REPLACE INTO statcache VALUES (?, ?, ?, ?, ?)", entries)
+		self.dbc.execute("""DELETE FROM statcache WHERE path NOT IN
+			(SELECT Filename FROM release_bin UNION SELECT path FROM srcfiles)""")
+
 	def relName(self, id):
 		"""
 		Codename of a release given as id
@@ -320,15 +751,95 @@ class Db:
 			yield dict(zip(r.keys(), r))
 
 
-	def listBin(self, arch, component, idrel, name):
+	def getIndexStanzas(self, arch, component, idrel, with_all=False,
+			batch=1000, named=False):
+		"""
+		Return an iterator over the Packages index of an arch,comp,release
+		triple.
+
+		The stanzas are rendered by the database and yielded as strings
+		of batch packages each, ready to be written into the index.
+		With named set, lists of (name, stanza) tuples are yielded instead.
+		"""
+		sql = """SELECT b.name, b.control || 'Filename: ' || r.Filename
+				|| char(10) || b.stanza
+			FROM release_bin r
+			JOIN binpackages b ON r.idpkg=b.id
+			WHERE r.idrel=? AND r.component=?
+				AND b.Architecture {}
+			ORDER BY b.name, b.id
+			""".format("IN ('all', ?)" if with_all else "= ?")
+		c = self.db.cursor()
+		c.row_factory = None
+		c.execute(sql, (idrel, component, arch))
+		while True:
+			rows = c.fetchmany(batch)
+			if len(rows) == 0: break
+			timing.count('db read', rows=len(rows))
+			yield rows if named else ''.join([r[1] for r in rows])
+		c.close()
+
+	def getSrcIndexStanzas(self, component, idrel, batch=1000, named=False):
+		"""
+		Return an iterator over the Sources index of a comp,release pair,
+		like getIndexStanzas
+		"""
+		c = self.db.cursor()
+		c.row_factory = None
+		c.execute(
+			"""SELECT s.name, s.stanza || 'Directory: ' || r.Directory
+				|| char(10) || char(10)
+			FROM release_src r
+			JOIN srcpackages s ON r.idsrc=s.id
+			WHERE r.idrel=? AND r.component=?
+			ORDER BY s.name, s.id""", (idrel, component))
+		while True:
+			rows = c.fetchmany(batch)
+			if len(rows) == 0: break
+			timing.count('db read', rows=len(rows))
+			yield rows if named else ''.join([r[1] for r in rows])
+		c.close()
+
+	# Fields for listBin available without parsing the control file
+	_listColumns = {
+		'id': 'b.id',
+		'name': 'b.name',
+		'Package': 'b.name',
+		'Version': 'b.Version',
+		'Architecture': 'b.Architecture',
+		'udeb': 'b.udeb',
+		'Size': 'b.Size',
+		'MD5Sum': 'b.MD5Sum',
+		'SHA1': 'b.SHA1',
+		'SHA256': 'b.SHA256',
+		'Description_md5': 'b.Description_md5',
+		'release': 'rel.Codename',
+		'component': 'r.component',
+		'Filename': 'r.Filename',
+	}
+
+	def listBin(self, arch, component, idrel, name, fields=None):
 		"""
 		Return an iterator over packages.
 		arch, component and relese can all be either None, meaning
 		no restriction, a string or number (in case of idrel),
 		or an iterable.
+
+		fields is the set of fields the caller is interested in. Only
+		those are selected, and the control file is only parsed if one
+		of them is not a column of the database. None means all fields.
 		"""
 		(sqlj, sqlw, sqlparams) = makeQuery(arch, component, idrel, name)
-		sql = 'SELECT b.*,rel.Codename AS release, r.component, r.Filename ' \
+		if fields is None:
+			cols = 'b.*,rel.Codename AS release, r.component, r.Filename'
+			parse = True
+		else:
+			known = [f for f in fields if f in self._listColumns]
+			parse = len(known) < len(fields)
+			if parse: known.append('control')
+			cols = ','.join(self._listColumns.get(f, 'b.' + f) + ' AS ' + f
+				for f in known) or 'b.id'
+		sql = 'SELECT ' + cols \
 			  + sqlj \
 			  + ' JOIN  releases rel on r.idrel = rel.id ' \
 			  + sqlw \
@@ -338,14 +849,54 @@ class Db:
 		while True:
 			r = self.dbc.fetchone()
 			if r is None: return
+			timing.count('db read', rows=1)
 			# make a dict from the query in the usual way
 			p = collections.defaultdict(lambda: '', zip(r.keys(), r))
+			if not parse:
+				yield p
+				continue
 			# update with keys from control file
 			p.update(Deb822(p['control']))
 			del p['control']
 			p['shortdesc'] = (p['Description'].partition('\n'))[0]
 			yield p
 
+	def searchBin(self, terms, arch, component, idrel, names=False,
+			limit=None):
+		"""
+		Return an iterator over packages matching all search terms,
+		best matches first.
+
+		Restrictions on arch, component and release are given as for
+		listBin. A package is returned as a dict with the fields release,
+		component, Filename, Package, Version, Architecture, shortdesc,
+		the control fields of the search table and rank.
+		"""
+		(sqlj, sqlw, sqlparams) = makeQuery(arch, component, idrel, [])
+		sqlw = (sqlw + ' AND ' if sqlw else ' WHERE ') + 'binsearch MATCH ?'
+		sqlparams.append(matchExpr(terms, names))
+		# package names weigh more than the other columns
+		sql = """SELECT rel.Codename AS release, r.component, r.Filename,
+				b.name AS Package, b.Version, b.Architecture,
+				s.Description, s.Provides, s.Section, s.Maintainer,
+				bm25(binsearch, 10.0, 1.0, 5.0, 1.0, 1.0) AS rank """ \
+			+ sqlj \
+			+ ' JOIN releases rel ON r.idrel = rel.id' \
+			+ ' JOIN binsearch s ON s.rowid = b.id' \
+			+ sqlw \
+			+ ' ORDER BY rank, rel.Codename, r.component, b.name'
+		if limit is not None:
+			sql += ' LIMIT ?'
+			sqlparams.append(limit)
+		logger.debug("Query for search = %s", sql)
+		self.dbc.execute(sql, sqlparams)
+		while True:
+			r = self.dbc.fetchone()
+			if r is None: return
+			p = collections.defaultdict(lambda: '', zip(r.keys(), r))
+			p['shortdesc'] = (p['Description'].partition('\n'))[0]
+			yield p
+
 	def listIds(self, arch, component, idrel, name):
 		"""
 		List package ids for given properties
@@ -364,19 +915,267 @@ class Db:
 		self.dbc.execute(sql, sqlparams)
 		return [row[0] for row in self.dbc.fetchall()]
 
-	def addBinaryRef(self, idrel, idpkg, component, filename):
+	def moveSelect(self, arch, component, idrel, name, torel, tocomp,
+			comps=None, archs=None):
+		"""
+		Select packages to be moved to another release and/or component
+
+		Packages are selected like in listIds and are to be moved to
+		release id torel and component tocomp, None meaning to keep the
+		current one. If comps is given, only packages whose new component
+		is in comps can be moved, if archs is given, only packages with an
+		architecture in archs. The selection is kept in the temporary
+		table mvsel for moveApply.
+
+		Return a tuple of lists of references (see binGetRefs):
+		- moves: the references to move, with the new release id, its
+		  name and the new component in the newrel, newCodename and
+		  newcomp attributes
+		- present: references to packages already present in their target
+		  release, to be deleted instead
+		- replaced: references to other versions of moved packages in the
+		  target releases, which must be deleted before the move
+		- skipped: references that cannot be moved due to comps or archs
+		"""
+		(sqlj, sqlw, sqlparams) = makeQuery(arch, component, idrel, name)
+		self.dbc.execute("""CREATE TEMP TABLE IF NOT EXISTS mvsel (
+			idpkg INTEGER, idrel INTEGER, newrel INTEGER, newcomp TEXT,
+			newfile TEXT, PRIMARY KEY (idpkg, idrel))""")
+		self.dbc.execute('DELETE FROM mvsel')
+		self.dbc.execute("""INSERT INTO mvsel
+			SELECT r.idpkg, r.idrel, COALESCE(?, r.idrel),
+				COALESCE(?, r.component), r.Filename"""
+			+ sqlj + sqlw, [torel, tocomp] + sqlparams)
+		def refs(cond, params=()):
+			"""References selected in mvsel matching cond"""
+			self.dbc.execute("""SELECT p.id, r.idrel, rl.Codename,
+					r.component, r.Filename, p.name, p.Version,
+					p.Architecture, p.SHA256, m.newrel,
+					nrl.Codename AS newCodename, m.newcomp
+				FROM mvsel m
+				JOIN binpackages p ON p.id = m.idpkg
+				JOIN release_bin r ON r.idpkg = m.idpkg AND r.idrel = m.idrel
+				JOIN releases rl ON r.idrel = rl.id
+				JOIN releases nrl ON m.newrel = nrl.id
+				WHERE """ + cond, params)
+			return [BinPkgRef(**dict(zip(row.keys(), row)))
+				for row in self.dbc.fetchall()]
+		def unselect(cond, params=()):
+			self.dbc.execute("""DELETE FROM mvsel WHERE (idpkg, idrel) IN
+				(SELECT m.idpkg, m.idrel FROM mvsel m
+				JOIN binpackages p ON p.id = m.idpkg
+				JOIN release_bin r ON r.idpkg = m.idpkg AND r.idrel = m.idrel
+				WHERE """ + cond + ')', params)
+		# Packages already where they should go
+		unselect('m.newrel = m.idrel AND m.newcomp = r.component')
+		skipped = []
+		for col, allowed in (('m.newcomp', comps), ('p.Architecture', archs)):
+			if allowed is None: continue
+			allowed = list(allowed)
+			cond = col + ' NOT IN (?' + ',?' * (len(allowed) - 1) + ')'
+			skipped += refs(cond, allowed)
+			unselect(cond, allowed)
+		cond = """m.newrel <> m.idrel AND EXISTS (SELECT 1 FROM release_bin t
+			WHERE t.idpkg = m.idpkg AND t.idrel = m.newrel)"""
+		present = refs(cond)
+		unselect(cond)
+		# Other versions in the target release, not moved themselves
+		self.dbc.execute("""SELECT DISTINCT o.id, r.idrel, rl.Codename,
+				r.component, r.Filename, o.name, o.Version, o.Architecture,
+				o.SHA256
+			FROM mvsel m
+			JOIN binpackages n ON n.id = m.idpkg
+			JOIN binpackages o ON o.name = n.name
+				AND o.Architecture = n.Architecture AND o.id <> n.id
+			JOIN release_bin r ON r.idpkg = o.id AND r.idrel = m.newrel
+			JOIN releases rl ON r.idrel = rl.id
+			WHERE NOT EXISTS (SELECT 1 FROM mvsel x
+				WHERE x.idpkg = r.idpkg AND x.idrel = r.idrel)""")
+		replaced = [BinPkgRef(**dict(zip(row.keys(), row)))
+			for row in self.dbc.fetchall()]
+		moves = refs('1')
+		return moves, present, replaced, skipped
+
+	def moveApply(self, moves):
+		"""
+		Move the references selected by moveSelect
+
+		The new file name of each reference is taken from its newFilename
+		attribute, as set by the store.
+		"""
+		self.dbc.executemany(
+			'UPDATE mvsel SET newfile=? WHERE idpkg=? AND idrel=?',
+			[(m.newFilename, m.id, m.idrel) for m in moves
+				if m.newFilename != m.Filename])
+		self.dbc.execute("""UPDATE release_bin
+			SET (idrel, component, Filename) = (
+				SELECT newrel, newcomp, newfile FROM mvsel m
+				WHERE m.idpkg = release_bin.idpkg
+					AND m.idrel = release_bin.idrel)
+			WHERE (idpkg, idrel) IN (SELECT idpkg, idrel FROM mvsel)""")
+		self.dbc.execute('DELETE FROM mvsel')
+
+	def cloneSelect(self, arch, component, idrel, name, torel, comps,
+			archs):
+		"""
+		Select packages of release idrel to be added to release torel
+
+		Packages are selected like in listIds from a single release. Only
+		packages with a component in comps and an architecture in archs
+		are selected, and only if torel holds no package of the same name
+		and architecture. The selection is kept in the temporary table
+		clonesel for cloneApply.
+
+		Return a tuple with the list of selected references and the list
+		of those not selected (see binGetRefs).
+		"""
+		(sqlj, sqlw, sqlparams) = makeQuery(arch, component, [idrel], name)
+		self.dbc.execute("""CREATE TEMP TABLE IF NOT EXISTS clonesel (
+			idpkg INTEGER PRIMARY KEY, component TEXT, newfile TEXT)""")
+		self.dbc.execute('DELETE FROM clonesel')
+		cond = ' AND r.component IN (?' + ',?' * (len(comps) - 1) + ')' \
+			+ ' AND b.Architecture IN (?' + ',?' * (len(archs) - 1) + ')' \
+			+ """ AND NOT EXISTS (SELECT 1 FROM release_bin t
+				JOIN binpackages o ON o.id = t.idpkg
+				WHERE t.idrel = ? AND o.name = b.name
+					AND o.Architecture = b.Architecture)"""
+		self.dbc.execute(
+			'INSERT INTO clonesel SELECT r.idpkg, r.component, r.Filename'
+			+ sqlj + sqlw + cond,
+			sqlparams + list(comps) + list(archs) + [torel])
+		sql = """SELECT b.id, r.idrel, rl.Codename, r.component, r.Filename,
+				b.name, b.Version, b.Architecture, b.SHA256""" + sqlj \
+			+ ' JOIN releases rl ON r.idrel = rl.id' + sqlw \
+			+ ' AND b.id {} IN (SELECT idpkg FROM clonesel)'
+		result = []
+		for neg in ('', 'NOT'):
+			self.dbc.execute(sql.format(neg), sqlparams)
+			result.append([BinPkgRef(**dict(zip(row.keys(), row)))
+				for row in self.dbc.fetchall()])
+		return tuple(result)
+
+	def cloneApply(self, torel, refs):
+		"""
+		Add the references selected by cloneSelect to release torel
+
+		The file name of each new reference is taken from the
+		newFilename attribute of refs, as set by the store.
+		"""
+		self.dbc.executemany(
+			'UPDATE clonesel SET newfile=? WHERE idpkg=?',
+			[(ref.newFilename, ref.id) for ref in refs
+				if ref.newFilename != ref.Filename])
+		self.dbc.execute("""INSERT INTO release_bin
+				(idrel, idpkg, component, Filename)
+			SELECT ?, idpkg, component, newfile FROM clonesel""", (torel,))
+		self.dbc.execute('DELETE FROM clonesel')
+
+	def snapshot(self, idrel, name):
+		"""
+		Create release name as a snapshot of release idrel
+
+		The snapshot gets a copy of all package references of the
+		release, so it shares the package files. Return its id.
+		"""
+		try:
+			self.dbc.execute("""INSERT INTO releases
+				(Codename, snapshotof, created)
+				VALUES (?, ?, datetime('now'))""", (name, idrel))
+		except sqlite3.IntegrityError:
+			raise DbError("Release %s exists already" % name)
+		id = self.dbc.lastrowid
+		self.dbc.execute("""INSERT INTO release_bin
+				(idrel, idpkg, component, Filename)
+			SELECT ?, idpkg, component, Filename FROM release_bin
+			WHERE idrel=?""", (id, idrel))
+		self.dbc.execute("""INSERT INTO release_src
+				(idrel, idsrc, component, Directory)
+			SELECT ?, idsrc, component, Directory FROM release_src
+			WHERE idrel=?""", (id, idrel))
+		return id
+
+	def snapshots(self):
+		"""
+		List all snapshots as tuples of id, name, the id of the release
+		they were taken of and their creation time, ordered by name
+		"""
+		c = self.db.cursor()
+		c.execute("""SELECT id, Codename, snapshotof, created FROM releases
+			WHERE snapshotof IS NOT NULL ORDER BY Codename""")
+		return [tuple(row) for row in c.fetchall()]
+
+	def delSnapshot(self, idrel):
+		"""
+		Delete the snapshot idrel
+
+		Its package references must have been deleted before, see
+		binDelRef and srcDelRef, as those may free package files.
+		"""
+		self.dbc.execute("DELETE FROM byhash WHERE idrel=?", (idrel,))
 		self.dbc.execute(
+			"DELETE FROM releases WHERE id=? AND snapshotof IS NOT NULL",
+			(idrel,))
+
+	def addBinaryRef(self, idrel, idpkg, component, filename):
+		self.addBinaryRefs([(idrel, idpkg, component, filename)])
+
+	def addBinaryRefs(self, refs):
+		"""
+		Add several references at once
+
+		refs is an iterable of (idrel, idpkg, component, Filename) tuples
+		"""
+		self.dbc.executemany(
 			"""INSERT OR IGNORE INTO release_bin
 			   (idrel, idpkg, component, Filename)
-			VALUES (?, ?, ?, ?)""", (idrel, idpkg, component, filename))
+			VALUES (?, ?, ?, ?)""", refs)
 
 	def delBinaryRef(self, id, idrel):
 		self.dbc.execute(
 			'DELETE FROM release_bin WHERE idrel=? AND idpkg=?',
 			(idrel, id))
 
+	def commit(self):
+		"""Make all changes so far visible to other connections"""
+		self.db.commit()
+		self.pending = 0
+
+	def lock(self):
+		"""
+		Take the exclusive lock of the repository, waiting for another
+		process holding it
+
+		A process takes the lock before its first change and holds it
+		until its changes are published, see unlock(). So only one process
+		at a time changes the repository and publishes it. The lock is an
+		flock on the file lock next to the database, the kernel releases
+		it when the process ends.
+		"""
+		if self.lockfd is not None: return
+		fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				logger.info("Waiting for another process changing the "
+					"repository")
+				fcntl.flock(fd, fcntl.LOCK_EX)
+		except:
+			os.close(fd)
+			raise
+		self.lockfd = fd
+
+	def unlock(self):
+		"""Commit all changes and release the lock taken by lock()"""
+		self.commit()
+		if self.lockfd is None: return
+		# unlock explicitly, forked workers may share the descriptor
+		fcntl.flock(self.lockfd, fcntl.LOCK_UN)
+		os.close(self.lockfd)
+		self.lockfd = None
+
 	def close(self):
 		self.dbc.close()
-		self.db.commit()
+		self.unlock()
 		self.db.close()
 
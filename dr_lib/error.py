@@ -17,3 +17,5 @@ class DbError(DebrepError): pass
 class ConfigError(DebrepError): pass
 class PkgError(DebrepError): pass
 class StoreError(DebrepError): pass
+class SignError(DebrepError): pass
+class FetchError(DebrepError): pass
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Verify a repository against its database
+
+Every package file the database refers to must exist with the size and
+SHA256 sum recorded, the store must hold its references the way it
+expects, no package file may be unknown to the database, and the
+published indices must have the content the database gives.
+
+Files are hashed by a pool of threads, hashlib releases the GIL while
+hashing, while the indices are checked. A file with several names, like
+a package referenced through symlinks or hardlinks, is hashed once.
+Files found correct are recorded in the stat cache of the database with
+their inode, size and modification time, a later run hashes them again
+only if one of those changed.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import os.path
+
+import index
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks files are read in for hashing
+_readSize = 1 << 20
+
+def _sha256(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			buf = f.read(_readSize)
+			if len(buf) == 0: break
+			h.update(buf)
+	return h.hexdigest()
+
+
+class Checker:
+	"""
+	Check the repository of config, with database db and store store
+
+	workers is the number of files hashed in parallel. With rehash, the
+	stat cache is ignored and all files are hashed. The indices of the
+	releases in snapshots are checked along with the configured ones.
+	"""
+
+	def __init__(self, config, db, store, workers=4, rehash=False,
+			snapshots=()):
+		self.config = config
+		self.snapshots = list(snapshots)
+		self.db = db
+		self.store = store
+		self.workers = workers
+		self.rehash = rehash
+		self.problems = []
+		self.hashed = 0
+		self.cached = 0
+
+	def problem(self, msg):
+		logger.debug("Problem: %s", msg)
+		self.problems.append(msg)
+
+	def knownFiles(self):
+		"""
+		Map all package files in the database to their Size and SHA256
+		sum, checking the references of each binary package on the way
+		"""
+		files = {}
+		for refs in self.db.binAllRefs():
+			for msg in self.store.checkRefs(refs):
+				self.problem(msg)
+			for ref in refs:
+				files[ref.Filename] = (int(ref.Size), ref.SHA256)
+		for path, size, sha256 in self.db.srcAllFiles():
+			files[path] = (int(size), sha256)
+		return files
+
+	def statFiles(self, files):
+		"""
+		Check existence and size of all files
+
+		Return the stat cache entries of files needing no hashing, and a
+		dict mapping (device, inode) to the names of the files to hash.
+		"""
+		cache = {} if self.rehash else self.db.statCache()
+		good = []
+		tohash = collections.defaultdict(list)
+		for path, (size, sha256) in files.items():
+			try:
+				st = os.stat(os.path.join(self.config.root, path))
+			except FileNotFoundError:
+				self.problem('%s: missing' % path)
+				continue
+			if st.st_size != size:
+				self.problem('%s: size %d, expected %d'
+					% (path, st.st_size, size))
+				continue
+			entry = (st.st_ino, st.st_size, st.st_mtime_ns, sha256)
+			if cache.get(path) == entry:
+				self.cached += 1
+				good.append((path,) + entry)
+			else:
+				tohash[(st.st_dev, st.st_ino)].append((path,) + entry)
+		return good, tohash
+
+	def run(self):
+		"""Check the repository and return the list of problems found"""
+		# nothing may change or be published while checking
+		self.db.lock()
+		files = self.knownFiles()
+		good, tohash = self.statFiles(files)
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as ex:
+			jobs = [(entries, ex.submit(_sha256,
+					os.path.join(self.config.root, entries[0][0])))
+				for entries in tohash.values()]
+			for release in list(self.config.releases.values()) \
+					+ self.snapshots:
+				for msg in index.verifyRelease(release, self.db, self.config):
+					self.problem(msg)
+			for path in self.store.storedFiles():
+				if path not in files:
+					self.problem('%s: not in the database' % path)
+			for entries, job in jobs:
+				try:
+					sha256 = job.result()
+				except OSError as e:
+					self.problem('%s: %s' % (entries[0][0], e))
+					continue
+				self.hashed += 1
+				for entry in entries:
+					if entry[4] == sha256:
+						good.append(entry)
+					else:
+						self.problem('%s: SHA256 mismatch' % entry[0])
+		self.db.statCacheUpdate(good)
+		self.db.unlock()
+		return self.problems
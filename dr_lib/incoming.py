@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Watch an incoming directory for new packages
+
+A package is complete once it has been renamed into the directory, or
+when it has not changed for a quiet period. The directory is watched
+with inotify where available, otherwise it is polled. Hidden files are
+ignored, as tools like rsync use them while transferring.
+"""
+import ctypes, ctypes.util
+import logging
+import os
+import os.path
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, see inotify(7)
+_IN_MODIFY      = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_Q_OVERFLOW  = 0x00004000
+
+_event = struct.Struct('iIII')
+
+class _Inotify:
+	"""Minimal inotify binding for a single directory"""
+
+	def __init__(self, path):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1')
+		mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO \
+			| _IN_CREATE | _IN_DELETE
+		if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+			errno = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(errno, 'inotify_add_watch', path)
+
+	def read(self, timeout):
+		"""Return a list of (mask, name) events, waiting at most timeout"""
+		r, _, _ = select.select([self.fd], [], [], timeout)
+		if len(r) == 0: return []
+		try:
+			buf = os.read(self.fd, 65536)
+		except BlockingIOError:
+			return []
+		events = []
+		pos = 0
+		while pos < len(buf):
+			_, mask, _, namelen = _event.unpack_from(buf, pos)
+			pos += _event.size
+			name = os.fsdecode(buf[pos:pos+namelen].rstrip(b'\0'))
+			pos += namelen
+			events.append((mask, name))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+class Watcher:
+	"""
+	Detect complete packages in a directory
+
+	quiet is the number of seconds a file must remain unchanged to be
+	considered complete. If poll is given, the directory is polled
+	every poll seconds instead of using inotify.
+	"""
+
+	def __init__(self, path, quiet=5, poll=None, suffixes=('.deb',)):
+		self.path = path
+		self.quiet = quiet
+		self.suffixes = suffixes
+		self.pending = {}   # name -> (size, mtime, unchanged since)
+		self.ready = []
+		self.inotify = None
+		self.poll = poll
+		if poll is None:
+			try:
+				self.inotify = _Inotify(path)
+			except (OSError, AttributeError) as e:
+				logger.warning("Cannot use inotify, polling instead: %s", e)
+				self.poll = 1
+		# packages already present
+		self.scan()
+
+	def wanted(self, name):
+		return not name.startswith('.') and name.endswith(self.suffixes) \
+			and os.path.isfile(os.path.join(self.path, name))
+
+	def changed(self, name):
+		"""Note that a file changed, so its quiet period starts again"""
+		try:
+			st = os.stat(os.path.join(self.path, name))
+		except FileNotFoundError:
+			self.pending.pop(name, None)
+			return
+		old = self.pending.get(name)
+		if old is None or old[:2] != (st.st_size, st.st_mtime_ns):
+			self.pending[name] = (st.st_size, st.st_mtime_ns, time.monotonic())
+
+	def complete(self, name):
+		self.pending.pop(name, None)
+		if name not in self.ready:
+			self.ready.append(name)
+
+	def gone(self, name):
+		self.pending.pop(name, None)
+		if name in self.ready:
+			self.ready.remove(name)
+
+	def scan(self):
+		"""Look at all files in the directory"""
+		names = set(n for n in os.listdir(self.path) if self.wanted(n))
+		for name in list(self.pending) + self.ready:
+			if name not in names: self.gone(name)
+		for name in names:
+			if name not in self.ready: self.changed(name)
+
+	def check(self):
+		"""Move files that stayed unchanged long enough to ready"""
+		now = time.monotonic()
+		for name in list(self.pending):
+			self.changed(name)
+			if name in self.pending and now - self.pending[name][2] >= self.quiet:
+				self.complete(name)
+
+	def wait(self, timeout):
+		"""Wait for changes for at most timeout seconds"""
+		# wake up regularly to see whether pending files became quiet
+		tick = min(timeout, self.poll or max(self.quiet / 4, 0.1))
+		if self.inotify is None:
+			time.sleep(tick)
+			self.scan()
+		else:
+			for mask, name in self.inotify.read(tick):
+				if mask & _IN_Q_OVERFLOW:
+					self.scan()
+				elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+					self.gone(name)
+				elif not self.wanted(name):
+					continue
+				elif mask & _IN_MOVED_TO:
+					self.complete(name)
+				else:
+					self.changed(name)
+		self.check()
+
+	def batches(self, window):
+		"""
+		Yield lists of complete packages
+
+		Once a package is complete, further packages completing within
+		window seconds are added to the same batch.
+		"""
+		try:
+			while True:
+				while len(self.ready) == 0:
+					self.wait(3600)
+				deadline = time.monotonic() + window
+				while True:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0: break
+					self.wait(remaining)
+				batch = [os.path.join(self.path, n) for n in self.ready]
+				self.ready = []
+				yield batch
+		finally:
+			if self.inotify is not None: self.inotify.close()
@@ -3,9 +3,16 @@
 Create an index file from an iterator that yields packages
 """
 
-import collections, datetime, logging, os, os.path, subprocess, types
-import bz2, lzma, zlib
+import collections, datetime, importlib, logging, os, os.path
+import queue, shutil, threading, types
+import concurrent.futures, multiprocessing
+import bz2, gzip, hashlib, lzma, zlib
+from debian.deb822 import Deb822
+from error import ConfigError
 from utils import Hasher, Hashes
+from pdiff import PDiffer
+import package
+import timing
 
 logger = logging.getLogger(__name__)
 
@@ -20,158 +27,801 @@ _supportedCompressors = {
 	'xz':   lzma.LZMACompressor
 }
 
+_defaultCompressors = ['none', 'gz', 'xz']
+
+def _mkCompressor(cname, level=None):
+	"""
+	Create a compressor object for the given format
+
+	level is the compression level (the preset for xz), None means
+	the default of the compression library
+	"""
+	if cname not in _supportedCompressors:
+		raise ConfigError("Unknown index compressor '{}'".format(cname))
+	if cname == 'gz':
+		if level is None: return zlib.compressobj(wbits=31)
+		return zlib.compressobj(level, wbits=31)
+	if level is None or cname == 'none':
+		return (_supportedCompressors[cname])()
+	if cname == 'xz':
+		return lzma.LZMACompressor(preset=level)
+	return (_supportedCompressors[cname])(level)
+
+# Size of the chunks fed to the compressor threads, and the number
+# of chunks that may be queued for each of them
+_chunkSize = 1 << 20
+_queueChunks = 4
+
+class _CompressorThread(threading.Thread):
+	"""
+	Compress, checksum and write one output format of an index
+
+	Data arrives in chunks through a bounded queue, None marks the end.
+	zlib, lzma and hashlib release the GIL while working on large
+	buffers, so the threads of the different formats run in parallel.
+	"""
+
+	def __init__(self, compressor, file, cname):
+		super().__init__(daemon=True)
+		self.cname = cname
+		self.compressor = compressor
+		self.file = file
+		self.csummer = Hasher()
+		self.written = 0
+		self.queue = queue.Queue(maxsize=_queueChunks)
+		self.error = None
+
+	def output(self, c):
+		self.csummer.update(c)
+		self.file.write(c)
+		self.written += len(c)
+
+	def run(self):
+		try:
+			with timing.phase('compress ' + self.cname):
+				self._run()
+		finally:
+			timing.count('compress ' + self.cname, bytes=self.written)
+
+	def _run(self):
+		try:
+			while True:
+				data = self.queue.get()
+				if data is None: break
+				self.output(self.compressor.compress(data))
+			self.output(self.compressor.flush())
+		except Exception as e:
+			self.error = e
+			# Keep consuming so the writer never blocks on a full queue
+			while data is not None: data = self.queue.get()
+		finally:
+			self.file.close()
+
 class CsumCompressor:
+	"""
+	Write data to several compressed files, computing their checksums
+
+	Each compressed format is produced by its own thread, see
+	_CompressorThread. Written strings are collected into chunks of
+	_chunkSize bytes before being handed to the threads.
 
-	def __init__(self, basedir, basename, compressors):
-		self.compressors = []
+	Files are written under a temporary name and renamed on close, so
+	an existing file is replaced, never modified.
+	"""
+
+	def __init__(self, basedir, basename, compressors, levels=None):
+		if levels is None: levels = {}
 		self.filenames = []
-		self.files = []
-		self.csummers = []
-		for cname in compressors:
-			fname = basename
-			if cname != 'none': fname += '.' + cname
-			self.filenames.append(fname)
-			self.files.append(open(os.path.join(basedir, fname), 'wb'))
-			if cname == 'gz':
-				compressor = (_supportedCompressors[cname])(wbits=31)
-			else:
-				compressor = (_supportedCompressors[cname])()
-			self.compressors.append(compressor)
-			self.csummers.append(Hasher())
+		self.threads = []
+		self.buf = bytearray()
+		cobjs = [_mkCompressor(cname, levels.get(cname))
+			for cname in compressors]
+		self.basedir = basedir
+		# Open all files before starting any thread, so no thread is
+		# left waiting for data if one cannot be opened
+		files = []
+		try:
+			for cname in compressors:
+				fname = basename
+				if cname != 'none': fname += '.' + cname
+				files.append(open(os.path.join(basedir, fname + '.new'), 'wb'))
+				self.filenames.append(fname)
+		except:
+			for f in files:
+				f.close()
+				os.remove(f.name)
+			raise
+		for cname, cobj, f in zip(compressors, cobjs, files):
+			thread = _CompressorThread(cobj, f, cname)
+			thread.start()
+			self.threads.append(thread)
+
+	def _push(self):
+		data = bytes(self.buf)
+		self.buf = bytearray()
+		for thread in self.threads:
+			thread.queue.put(data)
 
 	def write(self, s):
-		for comp,hash,file in zip(self.compressors, self.csummers, self.files):
-			c = comp.compress(s.encode())
-			hash.update(c)
-			file.write(c)
+		self.buf += s.encode()
+		if len(self.buf) >= _chunkSize: self._push()
 
 	def close(self):
+		if len(self.buf) > 0: self._push()
+		for thread in self.threads:
+			thread.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		paths = [os.path.join(self.basedir, f) for f in self.filenames]
+		for thread in self.threads:
+			if thread.error is None: continue
+			for path in paths: os.remove(path + '.new')
+			raise thread.error
 		result = []
-		for comp,hash,file,fname in zip(self.compressors, self.csummers,
-									 self.files, self.filenames):
-			c = comp.flush()
-			hash.update(c)
-			file.write(c)
-			file.close()
-			result.append((fname, hash.digest()))
+		for thread, fname, path in zip(self.threads, self.filenames, paths):
+			os.replace(path + '.new', path)
+			result.append((fname, thread.csummer.digest()))
 		return result
 
 
 class BinIndexer:
 
-	def __init__(self, arch, component, release, root):
+	basename = 'Packages'
+
+	def __init__(self, arch, component, release, root,
+			compressors=_defaultCompressors, levels=None):
 		self.rootdir = os.path.join(root, 'dists', release)
 		self.reldir  = os.path.join(component, 'binary-'+arch)
+		self.arch = arch
+		self.component = component
+		self.compressors = compressors
+		self.levels = levels
+
+	def stanzas(self, db, idrel, named=False):
+		"""The stanzas of the index from the database"""
+		return db.getIndexStanzas(self.arch, self.component, idrel,
+			named=named)
 
-	def create(self, iter):
+	def create(self, stanzas):
 		"""
 		Create the index files and return a list
 
+		stanzas is an iterator over strings of rendered package stanzas,
+		as returned by the getIndexStanzas method of the database.
 		Each list entry is a tuple with filename and its hashes
 		"""
-
-		def writepkg(pkg, f):
-			f.write(pkg['control']
-				+ "Filename: "    +  pkg['Filename']
-				+ '\nSize: '   + str(pkg['Size'])
-				+ '\nMD5Sum: '     + pkg['MD5Sum']
-				+ '\nSHA1: '       + pkg['SHA1']
-				+ '\nSHA256: '     + pkg['SHA256']
-				+ '\nDescription_md5: ' + pkg['Description_md5'] + '\n\n')
-
-
 		os.makedirs(os.path.join(self.rootdir, self.reldir), exist_ok=True)
 		cc = CsumCompressor(
 			self.rootdir,
-			os.path.join(self.reldir, 'Packages'),
-			['none', 'gz', 'xz']
+			os.path.join(self.reldir, self.basename),
+			self.compressors, self.levels
 		)
-		for pkg in iter: writepkg(pkg, cc)
+		for s in stanzas: cc.write(s)
 		return cc.close()
 
-def _updateRelease(release, db, root):
+class SrcIndexer(BinIndexer):
 	"""
-	Update the (changed) indices then create and sign the Release file
+	Create the Sources index of a component, the pseudo architecture
+	'source' of the release
+	"""
+
+	basename = 'Sources'
+
+	def __init__(self, component, release, root,
+			compressors=_defaultCompressors, levels=None):
+		super().__init__('source', component, release, root, compressors,
+			levels)
+		self.reldir = os.path.join(component, 'source')
+
+	def stanzas(self, db, idrel, named=False):
+		return db.getSrcIndexStanzas(self.component, idrel, named=named)
+
+class ContentsIndexer:
+	"""
+	Create a Contents index, listing for each file the packages
+	containing it
+	"""
+
+	def __init__(self, arch, component, release, root, compressors=['gz']):
+		self.rootdir = os.path.join(root, 'dists', release)
+		self.basename = os.path.join(component, 'Contents-' + arch)
+		self.compressors = compressors
+
+	def create(self, pkgs):
+		"""
+		Create the index files and return a list as BinIndexer.create
+
+		pkgs is an iterator over (location, list of files) tuples as
+		returned by the getContents method of the database.
+		"""
+		files = collections.defaultdict(list)
+		for location, names in pkgs:
+			for name in names:
+				files[name].append(location)
+		os.makedirs(os.path.join(self.rootdir, os.path.dirname(self.basename)),
+			exist_ok=True)
+		cc = CsumCompressor(self.rootdir, self.basename, self.compressors)
+		for name in sorted(files):
+			cc.write('{:<55} {}\n'.format(name, ','.join(sorted(files[name]))))
+		return cc.close()
+
+def _indexFiles(ca, release):
+	"""Names of the index files of a (comp,arch) pair in a release"""
+	if ca.arch == 'source':
+		base = os.path.join(ca.comp, 'source', 'Sources')
+	else:
+		base = os.path.join(ca.comp, 'binary-' + ca.arch, 'Packages')
+	files = set(base if c == 'none' else base + '.' + c
+		for c in release.indexcompressors)
+	if release.contents and ca.arch != 'source':
+		files.add(os.path.join(ca.comp, 'Contents-' + ca.arch + '.gz'))
+	if release.pdiffs:
+		files.add(os.path.join(base + '.diff', 'Index'))
+	return files
+
+def _createCA(db, arch, comp, relname, relid, root, compressors, levels,
+		contents, pdiffs):
+	"""
+	Create all indices of a (comp,arch) pair and return their sums
+
+	The architecture 'source' stands for the Sources index. With pdiffs
+	greater than zero, a patch from the previous Packages or Sources
+	index is created and the last pdiffs patches are kept.
+	"""
+	if arch == 'source':
+		indexer = SrcIndexer(comp, relname, root, compressors, levels)
+		contents = False
+	else:
+		indexer = BinIndexer(arch, comp, relname, root, compressors, levels)
+	if pdiffs > 0:
+		differ = PDiffer(indexer.rootdir, indexer.reldir, pdiffs,
+			indexer.basename)
+		isums = indexer.create(differ.filter(
+			indexer.stanzas(db, relid, named=True)))
+		isums += differ.finish()
+	else:
+		isums = indexer.create(indexer.stanzas(db, relid))
+	if contents:
+		isums += ContentsIndexer(arch, comp, relname, root).create(
+			db.getContents(arch, comp, relid))
+	return isums
+
+def _fillContents(release, db, root):
+	"""
+	Store the file lists of packages added while Contents indices were
+	not enabled. Those are read from the packages once.
+	"""
+	for id, filename, control in db.contentsMissing(release.id):
+		logger.info("Reading file list of %s", filename)
+		db.contentsSet(id, Deb822(control).get('Section'),
+			package.getFilesFromDeb(os.path.join(root, filename)))
+
+_worker = threading.local()
+
+def _initWorker(dbtype, dbargs, process=False):
+	"""Open a read-only database connection for an index worker"""
+	dbmod = importlib.import_module('db.' + dbtype)
+	_worker.db = dbmod.Db(types.SimpleNamespace(db=dbargs), readonly=True)
+	_worker.process = process
+
+def _createIndexWorker(phase, *jobargs):
+	"""
+	Create indices in a worker, using the worker's db connection
+
+	Return their sums, and the timings of a worker process
+	"""
+	if _worker.process: timing.reset()
+	with timing.phase(phase):
+		isums = _createCA(_worker.db, *jobargs)
+	return isums, timing.take() if _worker.process else []
+
+def _createIndices(releases, db, config):
+	"""
+	Regenerate all dirty indices of the given releases
+
+	With config.indexworkers greater than one, the indices are created
+	by a pool of threads or processes (depending on config.indexpool),
+	each worker querying the database through its own read-only
+	connection. Otherwise they are created one after the other using db.
+	"""
+	jobs = []
+	for release in releases:
+		if release.contents:
+			_fillContents(release, db, config.root)
+		for ca, cacache in _RepoCache[release.name].cacaches.items():
+			if not cacache.dirty: continue
+			logger.debug("Create index %s/%s of release %s",
+				ca.comp, ca.arch, release.name)
+			jobs.append((cacache,
+				'index {}/{}/{}'.format(release.name, ca.comp, ca.arch),
+				(ca.arch, ca.comp, _RepoCache[release.name].distname,
+				release.id, config.root,
+				release.indexcompressors, release.indexcompresslevels,
+				release.contents, config.pdiffkeep if release.pdiffs else 0)))
+	if config.indexworkers <= 1 or len(jobs) <= 1:
+		for cacache, phase, jobargs in jobs:
+			with timing.phase(phase):
+				cacache.isums = _createCA(db, *jobargs)
+			cacache.dirty = False
+		return
+	if config.indexpool == 'thread':
+		executor = concurrent.futures.ThreadPoolExecutor
+		poolargs = {}
+		process = False
+	elif config.indexpool == 'process':
+		executor = concurrent.futures.ProcessPoolExecutor
+		# Our modules are found via a sys.path set up at runtime, so
+		# workers must be forked rather than started from scratch
+		poolargs = dict(mp_context=multiprocessing.get_context('fork'))
+		process = True
+	else:
+		raise ConfigError("Unknown indexpool '{}'".format(config.indexpool))
+	# workers use their own connections and must see all changes
+	db.commit()
+	with executor(max_workers=config.indexworkers, initializer=_initWorker,
+			initargs=(config.dbtype, config.db, process), **poolargs) as ex:
+		futures = [(cacache, ex.submit(_createIndexWorker, phase, *jobargs))
+			for cacache, phase, jobargs in jobs]
+		for cacache, future in futures:
+			cacache.isums, timings = future.result()
+			timing.merge(timings)
+			cacache.dirty = False
+
+def _publishByHash(release, db, config):
+	"""
+	Make all indices of a release available under their SHA256 sum
+
+	Each index file is hardlinked to by-hash/SHA256/<sum> in its
+	directory. Files already present are left alone, so clients and
+	proxies may cache them forever. Sums older than the last
+	config.byhashkeep generations of an index are removed.
+	"""
+	reldir = _distDir(release, config.root)
+	for cacache in _RepoCache[release.name].cacaches.values():
+		for file, hashes in cacache.isums:
+			hashdir = os.path.join(reldir, os.path.dirname(file),
+				'by-hash', 'SHA256')
+			dst = os.path.join(hashdir, hashes.SHA256)
+			if not os.path.exists(dst):
+				os.makedirs(hashdir, exist_ok=True)
+				os.link(os.path.join(reldir, file), dst)
+			for old in db.byhashAdd(release.id, file, hashes.SHA256,
+					config.byhashkeep):
+				logger.debug("Remove %s/by-hash/SHA256/%s",
+					os.path.dirname(file), old)
+				try:
+					os.remove(os.path.join(hashdir, old))
+				except FileNotFoundError:
+					pass
+
+def _distDir(release, root):
+	"""The directory the indices of a release are currently written to"""
+	return os.path.join(root, 'dists', _RepoCache[release.name].distname)
+
+def _stageRelease(release, root):
+	"""
+	Create a staging directory for publishing a release
+
+	The published dists/<release> is a symlink to a directory
+	dists/.<release>.<generation>. The staging directory is the one for
+	the next generation, filled with hardlinks to all files of the
+	current one, so only changed files need to be written.
+
+	Return the name of the staging directory below dists
+	"""
+	dists = os.path.join(root, 'dists')
+	current = os.path.join(dists, release.name)
+	generation = 0
+	if os.path.islink(current):
+		try:
+			generation = int(os.readlink(current).rpartition('.')[2]) + 1
+		except ValueError:
+			pass
+	stagename = '.{}.{}'.format(release.name, generation)
+	staging = os.path.join(dists, stagename)
+	if os.path.lexists(staging):
+		# left over from an aborted publish
+		shutil.rmtree(staging)
+	if os.path.isdir(current):
+		shutil.copytree(current, staging, symlinks=True, copy_function=os.link)
+	else:
+		os.makedirs(staging)
+	logger.debug("Stage release %s in %s", release.name, staging)
+	return stagename
+
+def _flipRelease(release, root, stagename):
+	"""
+	Publish a staged release by atomically pointing the symlink
+	dists/<release> to the staging directory
+	"""
+	dists = os.path.join(root, 'dists')
+	current = os.path.join(dists, release.name)
+	old = None
+	if os.path.islink(current):
+		old = os.readlink(current)
+	elif os.path.isdir(current):
+		# First staged publish, the directory itself has to make way
+		old = '.{}.orig'.format(release.name)
+		logger.info("Convert %s into a symlink", current)
+		os.rename(current, os.path.join(dists, old))
+	tmplink = os.path.join(dists, '.{}.link'.format(release.name))
+	if os.path.lexists(tmplink): os.remove(tmplink)
+	os.symlink(stagename, tmplink)
+	os.replace(tmplink, current)
+	if old is not None and old != stagename:
+		shutil.rmtree(os.path.join(dists, old), ignore_errors=True)
+
+def _writeRelease(release, root):
+	"""
+	Create the Release file from the index checksums in the cache
+
+	All dirty indices must have been regenerated before. The file is
+	only replaced if anything but its date changed, so the signatures
+	stay valid otherwise. Return True if it was replaced.
 	"""
 	csums = dict(MD5Sum=[], SHA1=[], SHA256=[])
-	for comp in release.components:
-		for arch in release.architectures:
-			isum = BinIndexer(arch, comp, release.name, root).create(
-				db.getIndex(arch, comp, release.id)
-			)
-
-			for file,hashes in isum:
-				for hash in ('MD5Sum', 'SHA1', 'SHA256'):
-					csums[hash].append((
-						getattr(hashes,hash),
-						hashes.Size,
-						file
-					))
+	for cacache in _RepoCache[release.name].cacaches.values():
+		for file,hashes in cacache.isums:
+			for hash in ('MD5Sum', 'SHA1', 'SHA256'):
+				csums[hash].append((
+					getattr(hashes,hash),
+					hashes.Size,
+					file
+				))
 	# indices are written, compressed and checksums computed
 	# now print result to release file
-	with open(os.path.join(root, 'dists', release.name, 'Release'), 'w') as f:
-		for label in ('description', 'origin', 'label', 'version', 'suite'):
-			if not hasattr(release, label): continue
-			val = getattr(release, label)
-			if val is not None:
-				f.write(label.capitalize() + ': '+ val + '\n')
-		f.write('Codename: '+ release.name + '\n')
-		f.write('Architectures: ' + ' '.join(release.architectures) + '\n')
-		f.write('Components: ' + ' '.join(release.components) + '\n')
-		d = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S +0000')
-		f.write('Date: ' + d + '\n')
-		for hash in ('MD5Sum', 'SHA1', 'SHA256'):
-			f.write(hash + ':\n')
-			# sort list of (hexsum, size, filename) by the latter
-			csums[hash].sort(key=lambda x: x[2])
-			for hashval, size, fname in csums[hash]:
-				f.write(' ' + hashval + ' ' + size.rjust(9) + ' ' + fname + '\n')
-
-def _signRelease(release, root, key):
-	gpgargs = ['gpg', '--no-tty', '--batch' ]
-	if key is not None:
-		gpgargs += [ '--local-user', key ]
-	relfile = os.path.join(root, 'dists', release.name, 'Release')
-	inlfile = os.path.join(root, 'dists', release.name, 'InRelease')
-	sigfile = relfile + '.gpg'
-	if os.path.exists(sigfile): os.remove(sigfile)
-	res = subprocess.run(gpgargs + [
-		'--detach-sign', '-o', sigfile, relfile
-	])
-	if os.path.exists(inlfile): os.remove(inlfile)
-	res = subprocess.run(gpgargs + [
-		'--clearsign', '-o', inlfile, relfile
-	])
+	head = []
+	for label in ('description', 'origin', 'label', 'version', 'suite'):
+		if not hasattr(release, label): continue
+		val = getattr(release, label)
+		if val is not None:
+			head.append(label.capitalize() + ': '+ val + '\n')
+	head.append('Codename: '+ release.name + '\n')
+	head.append('Architectures: ' + ' '.join(release.architectures) + '\n')
+	head.append('Components: ' + ' '.join(release.components) + '\n')
+	if release.byhash:
+		head.append('Acquire-By-Hash: yes\n')
+	body = []
+	for hash in ('MD5Sum', 'SHA1', 'SHA256'):
+		body.append(hash + ':\n')
+		# sort list of (hexsum, size, filename) by the latter
+		csums[hash].sort(key=lambda x: x[2])
+		for hashval, size, fname in csums[hash]:
+			body.append(' ' + hashval + ' ' + size.rjust(9) + ' ' + fname + '\n')
+	relfile = os.path.join(_distDir(release, root), 'Release')
+	try:
+		with open(relfile) as f:
+			old = [l for l in f if not l.startswith('Date: ')]
+		if old == head + body:
+			logger.debug("Release '%s' unchanged", release.name)
+			return False
+	except FileNotFoundError:
+		pass
+	d = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S +0000')
+	with open(relfile + '.new', 'w') as f:
+		f.write(''.join(head) + 'Date: ' + d + '\n' + ''.join(body))
+	# replace, the old file may be hardlinked into the published tree
+	os.replace(relfile + '.new', relfile)
+	return True
+
+def _clearsignedText(signed):
+	"""The text of a clearsigned message, None if it is none"""
+	lines = signed.splitlines(keepends=True)
+	if len(lines) == 0 \
+			or lines[0].rstrip() != '-----BEGIN PGP SIGNED MESSAGE-----':
+		return None
+	# the armor headers end with an empty line
+	try:
+		start = [l.rstrip() for l in lines].index('') + 1
+	except ValueError:
+		return None
+	text = []
+	for line in lines[start:]:
+		if line.rstrip() == '-----BEGIN PGP SIGNATURE-----':
+			return ''.join(text)
+		# undo dash escaping
+		if line.startswith('- '): line = line[2:]
+		text.append(line)
+	return None
+
+def _isSigned(release, root):
+	"""
+	True if the Release file is signed
+
+	Both signatures must exist and InRelease must hold the current
+	Release file, older signatures are left in place when signing fails.
+	The signer replaces InRelease last, so Release.gpg is current then.
+	"""
+	reldir = _distDir(release, root)
+	if not os.path.exists(os.path.join(reldir, 'Release.gpg')):
+		return False
+	try:
+		with open(os.path.join(reldir, 'InRelease')) as f:
+			signed = _clearsignedText(f.read())
+		with open(os.path.join(reldir, 'Release')) as f:
+			return signed == f.read()
+	except FileNotFoundError:
+		return False
+
+def updateReleases(releases, db, config):
+	"""
+	Update the indices of all dirty releases, then write their Release
+	files and sign all changed ones at once with the configured signer
 
+	With config.stagedpublish, all files of a release are written to a
+	staging directory first, see _stageRelease, which is then published
+	at once.
+	"""
+	releases = [r for r in releases if cacheRelIsDirty(r.name)]
+	if len(releases) == 0: return
+	with timing.phase('publish'):
+		_updateReleases(releases, db, config)
+
+def _updateReleases(releases, db, config):
+	for release in releases:
+		_RepoCache[release.name].load()
+	if config.stagedpublish:
+		for release in releases:
+			_RepoCache[release.name].distname = _stageRelease(release,
+				config.root)
+	_createIndices(releases, db, config)
+	unsigned = []
+	for release in releases:
+		logger.debug("Update release '%s'", release.name)
+		if release.byhash:
+			_publishByHash(release, db, config)
+		if _writeRelease(release, config.root) \
+				or not _isSigned(release, config.root):
+			unsigned.append(release)
+	if len(unsigned) > 0:
+		with timing.phase('sign'):
+			config.getSigner().sign([
+				(os.path.join(_distDir(r, config.root), 'Release'), r.gpgkey)
+				for r in unsigned])
+	for release in releases:
+		rcache = _RepoCache[release.name]
+		if rcache.distname != release.name:
+			_flipRelease(release, config.root, rcache.distname)
+			rcache.distname = release.name
+		rcache.dirty = False
 
 def updateRelease(release, db, config):
-	logger.debug("Update release '%s'", release.name)
-	_updateRelease(release, db, config.root)
-	_signRelease(release, config.root, release.gpgkey)
+	updateReleases([release], db, config)
+
+def snapshotRelease(release, snapshot, db, config):
+	"""
+	Publish the indices of a new snapshot of release
+
+	The snapshot has the same packages as the release, so the index
+	files of the release are hardlinked as long as they are up to date
+	and nothing but the name differs in their configuration. Only the
+	remaining ones and the Release file are created.
+	"""
+	src = _RepoCache[release.name]
+	src.load()
+	srcdir = _distDir(release, config.root)
+	cache = ReleaseCache(snapshot, config.root)
+	_RepoCache[snapshot.name] = cache
+	cache.clear()
+	snapdir = _distDir(snapshot, config.root)
+	for ca, cacache in cache.cacaches.items():
+		wanted = _indexFiles(ca, snapshot)
+		isums = [(fname, hashes) for fname, hashes in src.cacaches[ca].isums
+			if fname in wanted]
+		if src.cacaches[ca].dirty \
+				or set(fname for fname, _ in isums) != wanted:
+			cacache.dirty = True
+			continue
+		for fname, _ in isums:
+			dst = os.path.join(snapdir, fname)
+			os.makedirs(os.path.dirname(dst), exist_ok=True)
+			if os.path.lexists(dst): os.remove(dst)
+			os.link(os.path.join(srcdir, fname), dst)
+		cacache.dirty = False
+		cacache.isums = isums
+	cache.dirty = True
+	updateReleases([snapshot], db, config)
+
+
+def unpublishRelease(name, root):
+	"""
+	Remove the published indices of release name, e.g. of a deleted
+	snapshot, along with the directories of a staged publish
+	"""
+	_RepoCache.pop(name, None)
+	dists = os.path.join(root, 'dists')
+	if not os.path.isdir(dists): return
+	current = os.path.join(dists, name)
+	if os.path.islink(current):
+		os.remove(current)
+	elif os.path.isdir(current):
+		shutil.rmtree(current)
+	prefix = '.{}.'.format(name)
+	for entry in os.listdir(dists):
+		suffix = entry.removeprefix(prefix)
+		if suffix == entry: continue
+		if suffix.isdigit() or suffix in ('orig', 'link'):
+			path = os.path.join(dists, entry)
+			if os.path.islink(path):
+				os.remove(path)
+			else:
+				shutil.rmtree(path, ignore_errors=True)
+
+
+def _decompressedSum(path):
+	"""SHA256 sum of the uncompressed content of an index file"""
+	opener = dict(gz=gzip.open, xz=lzma.open, bz2=bz2.open).get(
+		path.rpartition('.')[2], open)
+	h = hashlib.sha256()
+	with opener(path, 'rb') as f:
+		while True:
+			buf = f.read(_chunkSize)
+			if len(buf) == 0: break
+			h.update(buf)
+	return h.hexdigest()
+
+def verifyRelease(release, db, config):
+	"""
+	Check the published indices of a release
+
+	All files listed in the Release file must have the listed size and
+	SHA256 sum, and the Packages and Sources indices must have the
+	content the database gives. Return a list of problems found.
+	"""
+	reldir = os.path.join(config.root, 'dists', release.name)
+	try:
+		with open(os.path.join(reldir, 'Release')) as f:
+			rel = Deb822(f)
+	except FileNotFoundError:
+		return ['%s: not published' % release.name]
+	problems = []
+	sums = {}
+	for line in rel.get('SHA256', '').splitlines():
+		if line.strip() == '': continue
+		csum, size, fname = line.split()
+		sums[fname] = csum
+		path = os.path.join(reldir, fname)
+		try:
+			if os.path.getsize(path) != int(size) \
+					or Hasher.hash(path).SHA256 != csum:
+				problems.append('dists/%s/%s: does not match Release'
+					% (release.name, fname))
+		except FileNotFoundError:
+			problems.append('dists/%s/%s: missing' % (release.name, fname))
+	for comp in release.components:
+		for arch in list(release.architectures) + ['source']:
+			if arch == 'source':
+				indexer = SrcIndexer(comp, release.name, config.root)
+			else:
+				indexer = BinIndexer(arch, comp, release.name, config.root)
+			base = os.path.join(indexer.reldir, indexer.basename)
+			h = hashlib.sha256()
+			for s in indexer.stanzas(db, release.id): h.update(s.encode())
+			for fname in [base] + [base + '.' + c for c in ('gz', 'xz', 'bz2')]:
+				if fname not in sums: continue
+				if fname == base:
+					published = sums[fname]
+				else:
+					try:
+						published = _decompressedSum(os.path.join(reldir, fname))
+					except (OSError, EOFError, lzma.LZMAError):
+						continue
+				if published != h.hexdigest():
+					problems.append('dists/%s/%s: differs from the database'
+						% (release.name, base))
+				break
+			else:
+				problems.append('dists/%s/%s: not published'
+					% (release.name, base))
+	return problems
 
 
 CompArch = collections.namedtuple('CompArch', 'comp arch')
 
+def _file2CompArch(fname):
+	"""
+	Get the CompArch of an index file name as found in a Release file
+
+	Return None if the file is neither a binary package index, a
+	Sources index, their Packages.diff/Index (Sources.diff/Index) nor a
+	contents index. Sources indices get the architecture 'source'.
+	"""
+	parts = fname.split('/')
+	if len(parts) == 4 and parts[2] in ('Packages.diff', 'Sources.diff'):
+		parts = parts[:3]
+	if len(parts) == 2 and parts[1].startswith('Contents-'):
+		return CompArch(parts[0], parts[1][len('Contents-'):].split('.')[0])
+	if len(parts) == 3 and parts[1] == 'source' \
+			and parts[2].startswith('Sources'):
+		return CompArch(parts[0], 'source')
+	if len(parts) != 3 or not parts[1].startswith('binary-'):
+		return None
+	if not parts[2].startswith('Packages'):
+		return None
+	return CompArch(parts[0], parts[1][len('binary-'):])
+
 class ReleaseCache(types.SimpleNamespace):
 	"""
 	Cache index checksums for a release
 	"""
 
-	def __init__(self, release):
+	def __init__(self, release, root):
 		self.dirty = False
 		self.cacaches = dict()
 		self.release = release
+		self.root = root
+		# name of the directory below dists indices are written to
+		self.distname = release.name
+		# (comp,arch) pairs still dirty when the checksums were dropped
+		self.stale = set()
 
 	def clear(self):
 		for comp in self.release.components:
-			for arch in self.release.architectures:
+			for arch in list(self.release.architectures) + ['source']:
 				ca = CompArch(comp, arch)
 				self.cacaches[ca] = CompArchCache()
+		self.readRelease()
+		for ca in self.stale:
+			if ca not in self.cacaches: continue
+			self.cacaches[ca].dirty = True
+			self.cacaches[ca].isums = []
+		self.stale = set()
+
+	def load(self):
+		"""Read the index checksums, unless done since they were dropped"""
+		if len(self.cacaches) == 0:
+			self.clear()
+
+	def forget(self):
+		"""
+		Drop the index checksums, they are read again from the Release
+		file when needed next
+
+		Another process may publish the release meanwhile. Indices still
+		dirty, e.g. after a failed publish, stay dirty.
+		"""
+		self.stale |= set(ca for ca, cacache in self.cacaches.items()
+			if cacache.dirty)
+		self.cacaches = dict()
+
+	def readRelease(self):
+		"""
+		Fill the index checksums from the current Release file
+
+		Every (comp,arch) pair for which the Release file does not list
+		the configured indices, or whose index files are missing, is
+		marked dirty
+		"""
+		reldir = os.path.join(self.root, 'dists', self.release.name)
+		sums = collections.OrderedDict()
+		try:
+			with open(os.path.join(reldir, 'Release')) as f:
+				rel = Deb822(f)
+		except FileNotFoundError:
+			rel = {}
+		for hash in ('MD5Sum', 'SHA1', 'SHA256'):
+			if hash not in rel: continue
+			for line in rel[hash].splitlines():
+				if line.strip() == '': continue
+				hashval, size, fname = line.split()
+				sums.setdefault(fname, dict(Size=size))[hash] = hashval
+		for fname, fsums in sums.items():
+			ca = _file2CompArch(fname)
+			if ca not in self.cacaches or len(fsums) != 4: continue
+			self.cacaches[ca].isums.append((fname, Hashes(**fsums)))
+		for ca, cacache in self.cacaches.items():
+			wanted = _indexFiles(ca, self.release)
+			if set(fname for fname, _ in cacache.isums) != wanted \
+				or not all(os.path.exists(os.path.join(reldir, fname))
+					for fname in wanted):
+				logger.debug("No valid index for %s/%s in release %s",
+					ca.comp, ca.arch, self.release.name)
+				cacache.dirty = True
+				cacache.isums = []
 
 	def dirtyCA(self, comp, arch):
 		self.dirty = True
-		if len(self.cacaches) == 0:
-			self.clear()
+		self.load()
 		self.cacaches[CompArch(comp, arch)].dirty = True
 
 class CompArchCache(types.SimpleNamespace):
@@ -186,8 +836,24 @@ class CompArchCache(types.SimpleNamespace):
 _RepoCache = {}
 
 def cacheInit(config):
+	"""
+	Create the caches of all releases
+
+	Caches already present are kept, so a long running server keeps
+	its knowledge about dirty indices between requests.
+	"""
 	for release in config.releases.values():
-		_RepoCache[release.name] = ReleaseCache(release)
+		if release.name in _RepoCache: continue
+		_RepoCache[release.name] = ReleaseCache(release, config.root)
+
+def cacheForget():
+	"""
+	Drop the index checksums of all releases, see ReleaseCache.forget
+
+	Called when the repository is unlocked, see Db.lock
+	"""
+	for rcache in _RepoCache.values():
+		rcache.forget()
 
 def cacheDirty(rel, comp, arch):
 	_RepoCache[rel].dirtyCA(comp, arch)
@@ -10,10 +10,19 @@ Contains the classes
  - SrcPackage represent a source package
 
 """
+import bz2
+import collections
+import concurrent.futures
 import hashlib
+import io
+import lzma
+import multiprocessing
 import os
+import tarfile
+import timing
 import types
 import utils
+import zlib
 
 from debian.debfile import DebFile
 from debian.deb822 import Deb822
@@ -61,28 +70,364 @@ class BinPackageDeb(BinPackage):
 	def __str__(self):
 		return super().__str__() + '\norigfile: ' + self.origfile
 
-def getBinFromDeb(fname):
+	def cleanup(self):
+		"""Remove the spooled copy of the package if it was not used"""
+		if getattr(self, 'spoolfile', None) is None: return
+		try:
+			os.remove(self.spoolfile)
+		except FileNotFoundError:
+			pass
+		self.spoolfile = None
+
+# Size of the blocks a .deb file is read in
+_readSize = 1 << 20
+
+def _tarSize(field):
+	"""Value of a numeric tar header field, octal or base-256"""
+	if field[0] & 0x80:
+		return int.from_bytes(field[1:], 'big')
+	return int(field.strip(b'\0 ') or b'0', 8)
+
+def _paxPath(content):
+	"""The path from a pax extended header, None if not present"""
+	while len(content) > 0:
+		length, _, rest = content.partition(b' ')
+		record = content[len(length) + 1 : int(length)]
+		content = content[int(length):]
+		key, _, value = record.rstrip(b'\n').partition(b'=')
+		if key == b'path': return value
+	return None
+
+class _TarLister:
+	"""
+	List the names of the files in a tar stream fed in pieces
+
+	Only headers are looked at, file content is skipped. Directories
+	are not listed.
+	"""
+
+	def __init__(self):
+		self.buf = bytearray()
+		self.skip = 0
+		self.meta = None      # (type, size) of a long name or pax header
+		self.longname = None
+		self.names = []
+		self.done = False
+
+	def feed(self, data):
+		if self.done: return
+		self.buf += data
+		while True:
+			if self.skip > 0:
+				n = min(self.skip, len(self.buf))
+				del self.buf[:n]
+				self.skip -= n
+				if self.skip > 0: return
+			if self.meta is not None:
+				mtype, size = self.meta
+				padded = (size + 511) & ~511
+				if len(self.buf) < padded: return
+				content = bytes(self.buf[:size])
+				del self.buf[:padded]
+				self.meta = None
+				if mtype == b'L':
+					self.longname = content.rstrip(b'\0')
+				else:
+					self.longname = _paxPath(content) or self.longname
+				continue
+			if len(self.buf) < 512: return
+			hdr = bytes(self.buf[:512])
+			del self.buf[:512]
+			if hdr == bytes(512):
+				self.done = True
+				return
+			size = _tarSize(hdr[124:136])
+			mtype = hdr[156:157]
+			if mtype in (b'L', b'x'):
+				self.meta = (mtype, size)
+				continue
+			name = self.longname
+			self.longname = None
+			if name is None:
+				name = hdr[0:100].rstrip(b'\0')
+				if hdr[257:262] == b'ustar' and hdr[345] != 0:
+					name = hdr[345:500].rstrip(b'\0') + b'/' + name
+			if mtype not in (b'5', b'g'):
+				name = os.path.normpath(name.decode('utf-8', 'replace'))
+				self.names.append(name.lstrip('/'))
+			if mtype not in (b'1', b'2'):
+				self.skip = (size + 511) & ~511
+
+class _NoDecompressor:
+	def decompress(self, data): return data
+
+def _decompressor(name):
+	"""
+	Incremental decompressor for a tar member of a .deb, None if the
+	compression is not supported
+	"""
+	if name.endswith('.gz'): return zlib.decompressobj(wbits=47)
+	if name.endswith(('.xz', '.lzma')): return lzma.LZMADecompressor()
+	if name.endswith('.bz2'): return bz2.BZ2Decompressor()
+	if name.endswith('.tar'): return _NoDecompressor()
+	return None
+
+class _DebScanner:
+	"""
+	Parse a .deb while its data streams by
+
+	A .deb is an ar archive with the control tarball as its second
+	member, so it usually is found within the first few kilobytes.
+	Only the control member is kept in memory. If files is set, the
+	data member is decompressed on the fly to list the files of the
+	package.
+	"""
+
+	def __init__(self, files=False):
+		self.buf = bytearray()
+		self.magic = False
+		self.skip = 0
+		self.member = None
+		self.data = None      # (decompressor, remaining) of data member
+		self.lister = _TarLister() if files else None
+		self.done = False
+
+	def finish(self):
+		self.done = True
+		self.buf = None
+
+	def feed(self, data):
+		if self.done: return
+		self.buf += data
+		if not self.magic:
+			if len(self.buf) < 8: return
+			if self.buf[0:8] != b'!<arch>\n': return self.finish()
+			del self.buf[:8]
+			self.magic = True
+		while True:
+			if self.data is not None:
+				dec, remaining = self.data
+				n = min(remaining, len(self.buf))
+				self.lister.feed(dec.decompress(bytes(self.buf[:n])))
+				del self.buf[:n]
+				self.data = (dec, remaining - n)
+				if remaining > n: return
+				return self.finish()
+			if self.skip > 0:
+				n = min(self.skip, len(self.buf))
+				del self.buf[:n]
+				self.skip -= n
+				if self.skip > 0: return
+			if len(self.buf) < 60: return
+			name = self.buf[0:16].decode('ascii', 'replace').strip().rstrip('/')
+			try:
+				size = int(self.buf[48:58])
+			except ValueError:
+				return self.finish()
+			if name.startswith('control.tar'):
+				if len(self.buf) < 60 + size: return
+				self.member = bytes(self.buf[60 : 60 + size])
+				if self.lister is None: return self.finish()
+			elif name.startswith('data.tar'):
+				dec = _decompressor(name)
+				if self.lister is None or dec is None:
+					self.lister = None
+					return self.finish()
+				del self.buf[:60]
+				self.data = (dec, size)
+				continue
+			del self.buf[:60]
+			# ar members are aligned to even offsets
+			self.skip = size + (size & 1)
+
+	def control(self):
+		"""
+		Content of the control file, None if it could not be found
+
+		The latter happens for archive formats not supported by tarfile,
+		e.g. zstd compressed control members.
+		"""
+		if self.member is None: return None
+		try:
+			with tarfile.open(fileobj=io.BytesIO(self.member)) as tar:
+				for info in tar:
+					if os.path.normpath(info.name) == 'control':
+						return tar.extractfile(info).read().decode('utf-8')
+		except tarfile.TarError:
+			pass
+		return None
+
+	def files(self):
+		"""
+		Files of the package, None if they could not be listed
+
+		The latter happens for unsupported compression methods of
+		the data member.
+		"""
+		if self.lister is None or self.data is None or self.data[1] > 0:
+			return None
+		return self.lister.names
+
+def getFilesFromDeb(fname):
+	"""List the files contained in a .deb"""
+	with DebFile(fname).data.tgz() as tar:
+		return [os.path.normpath(info.name).lstrip('/')
+			for info in tar if not info.isdir()]
+
+def getBinFromDeb(fname, files=False):
 	"""
 	Get a binary package from a .deb file
+
+	The file is read only once, computing its size and checksums and
+	extracting the control file on the way. Nothing is written, only
+	the store copies the file if it has to be placed, see
+	BaseStore.placeFile.
+
+	If files is set, the list of files contained in the package is
+	stored in the files attribute, otherwise that attribute is None.
 	"""
-	dfile = DebFile(fname)
-	cdict = dfile.debcontrol()
+	with timing.phase('package read'):
+		return _getBinFromDeb(fname, files)
+
+def _getBinFromDeb(fname, files):
+	scanner = _DebScanner(files)
+	hasher = utils.Hasher()
+	with open(fname, 'rb') as f:
+		while True:
+			buf = f.read(_readSize)
+			if len(buf) == 0: break
+			hasher.update(buf)
+			scanner.feed(buf)
+	control = scanner.control()
+	if control is None:
+		# Fall back to the complete debfile parser
+		control = DebFile(fname).control.get_content('control', 'utf-8')
+	filelist = scanner.files()
+	if files and filelist is None:
+		filelist = getFilesFromDeb(fname)
+	cdict = Deb822(control)
 	result = BinPackageDeb(
 		id = -1,
 		name = cdict['Package'],
-		control = dfile.control.get_content('control', 'utf-8'),
-		cdict = dfile.debcontrol(),
+		control = control,
+		cdict = cdict,
 		Version = cdict['Version'],
 		Architecture = cdict['Architecture'],
 		udeb = fname.endswith('.udeb'),
 		Description_md5 = hashlib.md5(
 			cdict['Description'].encode() + b'\n').hexdigest(),
-		debfile = dfile,
-		origfile = fname
+		origfile = fname,
+		files = filelist
 	)
-	result.__dict__.update(utils.Hasher.hash(fname)._asdict())
+	result.__dict__.update(hasher.digest()._asdict())
 	return result
 
+def _getBinFromDebWorker(fname, files):
+	"""
+	Worker part of getBinsFromDebs
+
+	The parsed control data cannot be passed between processes,
+	so it is removed from the package.
+	"""
+	timing.reset()
+	pkg = getBinFromDeb(fname, files)
+	del pkg.cdict
+	return pkg, timing.take()
+
+def getBinsFromDebs(fnames, workers=1, files=False, onerror=None):
+	"""
+	Get binary packages from a list of .deb files
+
+	Return an iterator yielding the packages in the order of fnames.
+	With more than one worker, a pool of processes parses and hashes
+	the files in parallel, while the caller consumes the packages one
+	after another. At most twice as many files as there are workers
+	are read ahead. See getBinFromDeb for files.
+
+	If onerror is given, it is called with file name and exception for
+	each file that cannot be read, and that file is skipped. Otherwise
+	the exception is raised.
+	"""
+	if workers <= 1 or len(fnames) <= 1:
+		for fname in fnames:
+			try:
+				pkg = getBinFromDeb(fname, files)
+			except Exception as e:
+				if onerror is None: raise
+				onerror(fname, e)
+				continue
+			yield pkg
+		return
+
+	def done():
+		"""Wait for the oldest file read, return its package or None"""
+		fname, future = waiting.popleft()
+		try:
+			pkg, timings = future.result()
+		except Exception as e:
+			if onerror is None: raise
+			onerror(fname, e)
+			return None
+		timing.merge(timings)
+		pkg.cdict = Deb822(pkg.control)
+		return pkg
+
+	# Our modules are found via a sys.path set up at runtime, so
+	# workers must be forked rather than started from scratch
+	ex = concurrent.futures.ProcessPoolExecutor(workers,
+		mp_context=multiprocessing.get_context('fork'))
+	waiting = collections.deque()
+	try:
+		for fname in fnames:
+			waiting.append((fname,
+				ex.submit(_getBinFromDebWorker, fname, files)))
+			if len(waiting) <= 2 * workers: continue
+			pkg = done()
+			if pkg is not None: yield pkg
+		while len(waiting) > 0:
+			pkg = done()
+			if pkg is not None: yield pkg
+	finally:
+		ex.shutdown(cancel_futures=True)
+
+
+# Fields a Packages index adds to the control file of a package
+_indexFields = ('filename', 'size', 'md5sum', 'sha1', 'sha256', 'sha512',
+	'description-md5', 'description_md5')
+
+def getBinFromStanza(stanza, origfile):
+	"""
+	Get a binary package from its stanza in a Packages index
+
+	The metadata of the index is trusted, so the package file does not
+	need to be read. Size and checksums are taken from the stanza,
+	those missing there are None. origfile is where the package can be
+	downloaded from.
+	"""
+	cdict = Deb822()
+	for key, value in stanza.items():
+		if key.lower() not in _indexFields: cdict[key] = value
+	md5 = stanza.get('Description-md5') or stanza.get('Description_md5')
+	if md5 is None:
+		md5 = hashlib.md5(cdict['Description'].encode() + b'\n').hexdigest()
+	return BinPackageDeb(
+		id = -1,
+		name = cdict['Package'],
+		control = cdict.dump(),
+		cdict = cdict,
+		Version = cdict['Version'],
+		Architecture = cdict['Architecture'],
+		udeb = stanza['Filename'].endswith('.udeb'),
+		Description_md5 = md5,
+		origfile = origfile,
+		spoolfile = None,
+		files = None,
+		Size = stanza['Size'],
+		MD5Sum = stanza.get('MD5sum'),
+		SHA1 = stanza.get('SHA1'),
+		SHA256 = stanza['SHA256']
+	)
+
 
 class BinPackageDb(BinPackage):
 	"""
@@ -127,6 +472,103 @@ class BinPkgRef(types.SimpleNamespace):
 		return BinPkgRef.pkgformat.format_map(self.__dict__)
 
 
+class SrcPackage(types.SimpleNamespace):
+	"""
+	A source package derived from a .dsc file
+
+	files maps the names of all files of the package, the .dsc
+	included, to their hashes. Hashes not listed in the .dsc are None.
+	"""
+	def __str__(self):
+		return '\n'.join('{}: {}'.format(k, getattr(self, k))
+			for k in ('name', 'Version', 'SHA256', 'origfile'))
+
+	def sourceName(self):
+		return self.name
+
+	def stanza(self):
+		"""
+		The stanza of the package in a Sources index, except the
+		release specific Directory
+
+		The fields of the .dsc are taken over, with Source renamed to
+		Package and the .dsc itself added to the lists of files.
+		"""
+		out = Deb822()
+		out['Package'] = self.name
+		for key, value in self.cdict.items():
+			if key == 'Source': continue
+			out[key] = value
+		for key, attr in (('Files', 'MD5Sum'), ('Checksums-Sha1', 'SHA1'),
+				('Checksums-Sha256', 'SHA256')):
+			if key not in out: continue
+			out[key] += '\n {} {} {}'.format(getattr(self, attr), self.Size,
+				self.dscname)
+		for key in ('Priority', 'Section'):
+			if getattr(self, key) is not None: out[key] = getattr(self, key)
+		return out.dump()
+
+def _dscFiles(cdict):
+	"""Map the names of the files listed in a .dsc to their hashes"""
+	sums = {}
+	for key, attr in (('Files', 'MD5Sum'), ('Checksums-Sha1', 'SHA1'),
+			('Checksums-Sha256', 'SHA256')):
+		for line in cdict.get(key, '').splitlines():
+			if line.strip() == '': continue
+			csum, size, name = line.split()
+			sums.setdefault(name, dict(Size=size))[attr] = csum
+	return dict((name, utils.Hashes(s['Size'], s.get('MD5Sum'),
+		s.get('SHA1'), s.get('SHA256'))) for name, s in sums.items())
+
+def getSrcFromDsc(fname):
+	"""
+	Get a source package from a .dsc file
+
+	Only the .dsc itself is read and hashed, the other files of the
+	package are only looked at when they are added to the repository.
+	Section and Priority are taken from the first entry of the
+	Package-List, if there is one.
+	"""
+	with open(fname, 'rb') as f:
+		data = f.read()
+	hasher = utils.Hasher()
+	hasher.update(data)
+	cdict = Deb822(data)
+	dscname = os.path.basename(fname)
+	section = priority = None
+	plist = cdict.get('Package-List', '').strip().splitlines()
+	if len(plist) > 0 and len(plist[0].split()) >= 4:
+		section, priority = plist[0].split()[2:4]
+	result = SrcPackage(
+		id = -1,
+		name = cdict['Source'],
+		dsc = data.decode('utf-8'),
+		cdict = cdict,
+		Version = cdict['Version'],
+		Section = section,
+		Priority = priority,
+		dscname = dscname,
+		origfile = fname,
+		files = _dscFiles(cdict)
+	)
+	result.__dict__.update(hasher.digest()._asdict())
+	result.files[dscname] = hasher.digest()
+	return result
+
+class SrcPkgRef(types.SimpleNamespace):
+	"""
+	A reference to a source package
+
+	Holds id, idrel, Codename, component and Directory of the
+	reference and name, Version and SHA256 (of the .dsc) of the package
+	"""
+
+	strformat = "{name}-{Version}(source) in {Codename}/{component}"
+
+	def __str__(self):
+		return SrcPkgRef.strformat.format_map(self.__dict__)
+
+
 
 if __name__ == '__main__':
 	fname = sys.argv[1]
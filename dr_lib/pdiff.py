@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Create Packages.diff directories for incremental index updates
+
+apt can update a Packages (or Sources) index by applying ed style patches instead of
+downloading it completely. The patches between consecutive generations
+of an index are listed in Packages.diff/Index (Sources.diff/Index).
+
+Patches are not computed by diffing index files. Instead, for each
+generation a manifest is kept in Packages.diff/.manifest, holding for
+each package stanza its name, checksum and number of lines. The stanzas
+of the new generation arrive sorted by name from the database and are
+merged against the manifest of the previous one.
+"""
+
+import datetime, gzip, hashlib, logging, os, os.path, zlib
+from debian.deb822 import Deb822
+from utils import Hasher
+
+logger = logging.getLogger(__name__)
+
+class PDiffer:
+	"""
+	Create the patch from the previous to the current generation of a
+	Packages index while its stanzas stream by
+
+	basename is the name of the index, i.e. Packages or Sources
+	"""
+
+	def __init__(self, rootdir, reldir, keep, basename='Packages'):
+		self.rootdir = rootdir
+		self.reldir = reldir
+		self.diffname = basename + '.diff'
+		self.diffdir = os.path.join(rootdir, reldir, self.diffname)
+		self.keep = keep
+		self.hasher = Hasher()
+		self.manifest = []
+		self.hunks = []
+		self.loadManifest()
+		self.pos = 0      # index into old manifest
+		self.line = 1     # first line of old stanza at pos
+
+	def loadManifest(self):
+		"""Read the manifest of the previous generation"""
+		self.old = None
+		self.oldsum = None
+		try:
+			with open(os.path.join(self.diffdir, '.manifest'), 'rb') as f:
+				lines = zlib.decompress(f.read()).decode().split('\n')
+		except FileNotFoundError:
+			return
+		self.oldsum = lines[0]
+		self.old = []
+		for line in lines[1:]:
+			if line == '': continue
+			name, csum, nlines = line.split('\t')
+			self.old.append((name, csum, int(nlines)))
+
+	def hunk(self, first, last, text):
+		"""Replace old lines first..last by text, merging adjacent hunks"""
+		if len(self.hunks) > 0 and self.hunks[-1][1] + 1 == first:
+			pfirst, _, ptext = self.hunks[-1]
+			self.hunks[-1] = (pfirst, last, ptext + text)
+		else:
+			self.hunks.append((first, last, text))
+
+	def oldGroup(self, name):
+		"""Consume the old stanzas of name, return their sums and lines"""
+		first = self.line
+		csums = []
+		while self.pos < len(self.old) and self.old[self.pos][0] == name:
+			csums.append(self.old[self.pos][1])
+			self.line += self.old[self.pos][2]
+			self.pos += 1
+		return first, csums
+
+	def group(self, name, stanzas):
+		"""Merge all new stanzas of a package name"""
+		if self.old is None: return
+		while self.pos < len(self.old) and self.old[self.pos][0] < name:
+			first, _ = self.oldGroup(self.old[self.pos][0])
+			self.hunk(first, self.line - 1, '')
+		first, csums = self.oldGroup(name)
+		if csums != [csum for csum, _ in stanzas]:
+			self.hunk(first, self.line - 1, ''.join(t for _, t in stanzas))
+
+	def filter(self, batches):
+		"""
+		Pass stanzas on to the index while recording them
+
+		batches is an iterator over lists of (name, stanza) tuples as
+		returned by getIndexStanzas with named set. Yield the text of
+		each batch.
+		"""
+		name = None
+		stanzas = []
+		for batch in batches:
+			for n, text in batch:
+				if n != name:
+					if name is not None: self.group(name, stanzas)
+					name = n
+					stanzas = []
+				csum = hashlib.sha1(text.encode()).hexdigest()
+				stanzas.append((csum, text))
+				self.manifest.append((n, csum, text.count('\n')))
+			text = ''.join(t for _, t in batch)
+			self.hasher.update(text.encode())
+			yield text
+		if name is not None: self.group(name, stanzas)
+		if self.old is not None:
+			while self.pos < len(self.old):
+				first, _ = self.oldGroup(self.old[self.pos][0])
+				self.hunk(first, self.line - 1, '')
+
+	def edScript(self):
+		"""The patch as ed script, changes at the end come first"""
+		result = []
+		for first, last, text in reversed(self.hunks):
+			if last < first:
+				result.append('{}a\n{}.\n'.format(first - 1, text))
+			elif text == '':
+				result.append('{},{}d\n'.format(first, last))
+			else:
+				result.append('{},{}c\n{}.\n'.format(first, last, text))
+		return ''.join(result)
+
+	def writeFile(self, name, data):
+		"""Write a file in the diff directory by replacing it"""
+		path = os.path.join(self.diffdir, name)
+		with open(path + '.new', 'wb') as f:
+			f.write(data)
+		os.replace(path + '.new', path)
+
+	def readIndex(self):
+		"""Return the history of the current Index as list of tuples
+		(patch, history sum, history size, patch sum, patch size,
+		download sum, download size)
+		"""
+		try:
+			with open(os.path.join(self.diffdir, 'Index')) as f:
+				index = Deb822(f)
+		except FileNotFoundError:
+			return []
+		fields = {}
+		for field in ('SHA256-History', 'SHA256-Patches', 'SHA256-Download'):
+			fields[field] = {}
+			for line in index.get(field, '').splitlines():
+				if line.strip() == '': continue
+				csum, size, patch = line.split()
+				fields[field][patch.removesuffix('.gz')] = (csum, size)
+		return [(patch,) + hist + fields['SHA256-Patches'][patch]
+				+ fields['SHA256-Download'][patch]
+			for patch, hist in fields['SHA256-History'].items()]
+
+	def finish(self):
+		"""
+		Write patch, Index and manifest of the new generation
+
+		Return a list with the Index file name (relative to rootdir) and
+		its hashes, like BinIndexer.create
+		"""
+		os.makedirs(self.diffdir, exist_ok=True)
+		cur = self.hasher.digest()
+		cursum = cur.SHA256 + ' ' + cur.Size
+		history = self.readIndex()
+		if self.old is not None and self.oldsum != cursum:
+			# Patch names are timestamps, bump a name already in use
+			# by a second, that keeps them unique and in order
+			now = datetime.datetime.utcnow().replace(microsecond=0)
+			used = {h[0] for h in history}
+			while True:
+				patch = now.strftime('%Y-%m-%d-%H%M.%S')
+				if (patch not in used and not os.path.exists(
+						os.path.join(self.diffdir, patch + '.gz'))):
+					break
+				now += datetime.timedelta(seconds=1)
+			script = self.edScript().encode()
+			zipped = gzip.compress(script, mtime=0)
+			self.writeFile(patch + '.gz', zipped)
+			logger.debug("Patch %s/%s with %d hunks", self.reldir, patch,
+				len(self.hunks))
+			history.append((patch,) + tuple(self.oldsum.split())
+				+ (hashlib.sha256(script).hexdigest(), str(len(script)),
+				hashlib.sha256(zipped).hexdigest(), str(len(zipped))))
+		for entry in history[:-self.keep]:
+			try:
+				os.remove(os.path.join(self.diffdir, entry[0] + '.gz'))
+			except FileNotFoundError:
+				pass
+		history = history[-self.keep:]
+		lines = ['SHA256-Current: ' + cursum, 'SHA256-History:']
+		lines += [' {} {:>9} {}'.format(h[1], h[2], h[0]) for h in history]
+		lines.append('SHA256-Patches:')
+		lines += [' {} {:>9} {}'.format(h[3], h[4], h[0]) for h in history]
+		lines.append('SHA256-Download:')
+		lines += [' {} {:>9} {}.gz'.format(h[5], h[6], h[0]) for h in history]
+		index = ('\n'.join(lines) + '\n').encode()
+		self.writeFile('Index', index)
+		self.writeFile('.manifest', zlib.compress(('\n'.join([cursum]
+			+ ['\t'.join((n, c, str(l))) for n, c, l in self.manifest])
+			+ '\n').encode()))
+		h = Hasher()
+		h.update(index)
+		return [(os.path.join(self.reldir, self.diffname, 'Index'),
+			h.digest())]
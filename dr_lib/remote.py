@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Import packages from another apt repository
+
+The Release file of the remote suite is read first, then the Packages
+index of each wanted component and architecture. An index is downloaded
+completely and checked against the Release file, but parsed one stanza
+after the other while it is decompressed. The metadata of the index is
+trusted: packages already in the repository, recognized by their SHA256
+sum, are not downloaded at all, and packages downloaded are not parsed,
+only their checksums are computed while they arrive.
+
+Downloads are done by a bounded pool of threads into the spool
+directory, named by the SHA256 sum of the package. An interrupted
+download leaves a partial file behind, which is continued by the next
+attempt, even in a later run.
+
+Besides http and https, file URIs are supported.
+"""
+import collections
+import concurrent.futures
+import fnmatch
+import gzip
+import io
+import logging
+import lzma
+import os
+import os.path
+import subprocess
+import tempfile
+import urllib.parse
+import urllib.request
+
+from debian.deb822 import Deb822
+from error import FetchError, PkgError
+from utils import Hasher
+import package
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks downloaded files are read in
+_readSize = 1 << 20
+# Number of attempts to download a file
+_attempts = 3
+
+def _open(url, offset=0):
+	"""
+	Open url for reading, starting at offset
+
+	Return the file object and the offset it actually starts at, which
+	is 0 if the server does not support ranges.
+	"""
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme == 'file':
+		f = open(urllib.request.url2pathname(parts.path), 'rb')
+		f.seek(offset)
+		return f, offset
+	req = urllib.request.Request(url)
+	if offset > 0:
+		req.add_header('Range', 'bytes={}-'.format(offset))
+	resp = urllib.request.urlopen(req, timeout=60)
+	if offset > 0 and resp.status != 206:
+		return resp, 0
+	return resp, offset
+
+def _fetch(url, part, size):
+	"""
+	Download url to the file part, continuing a partial download
+
+	Return the hashes of the complete file.
+	"""
+	hasher = Hasher()
+	offset = 0
+	if os.path.exists(part):
+		offset = os.path.getsize(part)
+		if offset > size:
+			offset = 0
+		else:
+			logger.debug("Resume %s at %d", url, offset)
+			with open(part, 'rb') as f:
+				while True:
+					buf = f.read(_readSize)
+					if len(buf) == 0: break
+					hasher.update(buf)
+	if offset == size and size > 0:
+		return hasher.digest()
+	src, start = _open(url, offset)
+	if start != offset:
+		hasher = Hasher()
+	with src, open(part, 'ab' if start > 0 else 'wb') as out:
+		while True:
+			buf = src.read(_readSize)
+			if len(buf) == 0: break
+			hasher.update(buf)
+			out.write(buf)
+	return hasher.digest()
+
+
+class Remote:
+	"""
+	A suite of a remote apt repository
+
+	uri is the base URI of the repository, i.e. the directory holding
+	dists and pool. If keyring is given, the signature of the Release
+	file is checked with gpgv against the keys in it.
+	"""
+
+	def __init__(self, uri, suite, keyring=None):
+		self.uri = uri.rstrip('/') + '/'
+		self.distdir = 'dists/{}/'.format(suite)
+		data = self.get(self.distdir + 'Release')
+		if keyring is not None:
+			self.verify(data, keyring)
+		rel = Deb822(data)
+		self.components = rel.get('Components', '').split()
+		self.architectures = rel.get('Architectures', '').split()
+		self.sums = {}
+		for line in rel.get('SHA256', '').splitlines():
+			if line.strip() == '': continue
+			csum, size, fname = line.split()
+			self.sums[fname] = (csum, int(size))
+
+	def get(self, path):
+		"""The content of a small remote file"""
+		try:
+			f, _ = _open(self.uri + path)
+			with f:
+				return f.read()
+		except OSError as e:
+			raise FetchError("Cannot get {}{}: {}".format(self.uri, path, e))
+
+	def verify(self, data, keyring):
+		"""Check the detached signature of the Release file"""
+		sig = self.get(self.distdir + 'Release.gpg')
+		with tempfile.TemporaryDirectory() as tmp:
+			for name, content in (('Release', data), ('Release.gpg', sig)):
+				with open(os.path.join(tmp, name), 'wb') as f:
+					f.write(content)
+			res = subprocess.run(['gpgv', '--keyring', keyring,
+				os.path.join(tmp, 'Release.gpg'), os.path.join(tmp, 'Release')],
+				stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		if res.returncode != 0:
+			raise FetchError("Bad signature of {}{}Release: {}".format(
+				self.uri, self.distdir, res.stderr.decode(errors='replace')))
+
+	def index(self, comp, arch):
+		"""
+		Iterate over the stanzas of the Packages index of comp and arch
+
+		The smallest compressed form listed in the Release file is
+		downloaded. Nothing is returned if the Release file does not list
+		the index.
+		"""
+		base = '{}/binary-{}/Packages'.format(comp, arch)
+		for ext, opener in (('.xz', lzma.open), ('.gz', gzip.open),
+				('', None)):
+			if base + ext in self.sums: break
+		else:
+			logger.debug("No index %s in %s", base, self.uri)
+			return
+		csum, size = self.sums[base + ext]
+		url = self.uri + self.distdir + base + ext
+		logger.info("Read index %s", url)
+		with tempfile.TemporaryFile() as tmp:
+			hasher = Hasher()
+			try:
+				src, _ = _open(url)
+				with src:
+					while True:
+						buf = src.read(_readSize)
+						if len(buf) == 0: break
+						hasher.update(buf)
+						tmp.write(buf)
+			except OSError as e:
+				raise FetchError("Cannot get {}: {}".format(url, e))
+			digest = hasher.digest()
+			if digest.SHA256 != csum or int(digest.Size) != size:
+				raise FetchError("Checksum mismatch for {}".format(url))
+			tmp.seek(0)
+			raw = opener(tmp) if opener is not None else tmp
+			with io.TextIOWrapper(raw, encoding='utf-8') as text:
+				yield from Deb822.iter_paragraphs(text, use_apt_pkg=False)
+
+	def download(self, pkg, spool):
+		"""
+		Download a package into the spool directory
+
+		The file is checked against size and SHA256 sum of the index,
+		and all checksums of the package are set from it.
+		"""
+		part = os.path.join(spool, pkg.SHA256 + '.part')
+		for attempt in range(1, _attempts + 1):
+			try:
+				digest = _fetch(pkg.origfile, part, int(pkg.Size))
+				break
+			except OSError as e:
+				if attempt == _attempts:
+					raise FetchError("Cannot get {}: {}".format(pkg.origfile, e))
+				logger.warning("Downloading %s failed, retrying: %s",
+					pkg.origfile, e)
+		if digest.SHA256 != pkg.SHA256 or digest.Size != str(pkg.Size):
+			os.remove(part)
+			raise PkgError("Checksum mismatch for {}".format(pkg.origfile))
+		pkg.spoolfile = os.path.join(spool, pkg.SHA256 + '.deb')
+		os.replace(part, pkg.spoolfile)
+		pkg.__dict__.update(digest._asdict())
+		logger.debug("Downloaded %s", pkg.origfile)
+
+	def packages(self, comps, archs, names, have, spool, workers=4,
+			onerror=None):
+		"""
+		Iterate over the packages of the given components and
+		architectures whose name matches one of the patterns in names,
+		or all of them if names is empty
+
+		Yield (component, package) tuples. Packages whose SHA256 sum is
+		in the set have are not downloaded, all others are downloaded by
+		a pool of workers, at most twice as many packages as there are
+		workers are waiting to be yielded. A package is yielded only once
+		even if it is listed in several indices, like those of
+		architecture all. If onerror is given, it is called with the URI
+		and exception for each package that cannot be downloaded, and that
+		package is skipped. Otherwise the exception is raised.
+		"""
+		def wanted():
+			seen = set()
+			for comp in comps:
+				for arch in archs:
+					for stanza in self.index(comp, arch):
+						if 'SHA256' not in stanza or stanza['SHA256'] in seen:
+							continue
+						seen.add(stanza['SHA256'])
+						if len(names) > 0 and not any(fnmatch.fnmatch(
+								stanza['Package'], n) for n in names):
+							continue
+						yield comp, package.getBinFromStanza(stanza,
+							self.uri + stanza['Filename'])
+
+		ex = concurrent.futures.ThreadPoolExecutor(workers)
+		waiting = collections.deque()
+		try:
+			for comp, pkg in wanted():
+				future = None
+				if pkg.SHA256 not in have:
+					future = ex.submit(self.download, pkg, spool)
+				waiting.append((comp, pkg, future))
+				while len(waiting) > 2 * workers or \
+						(len(waiting) > 0 and waiting[0][2] is None):
+					comp, pkg, future = waiting.popleft()
+					if self._done(pkg, future, onerror): yield comp, pkg
+			while len(waiting) > 0:
+				comp, pkg, future = waiting.popleft()
+				if self._done(pkg, future, onerror): yield comp, pkg
+		finally:
+			ex.shutdown(cancel_futures=True)
+
+	@staticmethod
+	def _done(pkg, future, onerror):
+		"""Wait for the download of a package, True if it succeeded"""
+		if future is None: return True
+		try:
+			future.result()
+		except Exception as e:
+			if onerror is None: raise
+			onerror(pkg.origfile, e)
+			return False
+		return True
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Serve debrep requests over a Unix socket
+
+A long running server keeps configuration, database connection and the
+index cache in memory. Clients send their command line and working
+directory as a single JSON line and get back a JSON line with exit
+status and output.
+
+All requests are executed one after another by a single writer, the
+thread running Server.run. Requests changing the repository are not
+answered before their changes are published. Publishing is done once
+for all of them after a debounce window, starting with the first
+change, has passed.
+
+A server implements the following methods:
+
+  execute(self, req) : optional
+    Run the command line in req.argv, with req.cwd as the working
+    directory of the client, setting req.status, req.stdout and
+    req.stderr. Return True if the request changed the repository, so
+    it must be published before it is answered.
+
+    In the Server, every request is refused with status 2.
+
+  publish(self) : optional
+    Publish all changes made by the requests executed so far.
+
+    In the Server, there is nothing to publish.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import types
+
+from error import DebrepError
+
+logger = logging.getLogger(__name__)
+
+def request(path, argv, cwd):
+	"""
+	Execute a command line in the server listening at path
+
+	Return a dict with status, stdout and stderr of the command, or None
+	if no server is running.
+	"""
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		s.connect(path)
+	except (FileNotFoundError, ConnectionRefusedError):
+		s.close()
+		return None
+	with s, s.makefile('rwb') as f:
+		f.write(json.dumps(dict(argv=argv, cwd=cwd)).encode() + b'\n')
+		f.flush()
+		line = f.readline()
+	if len(line) == 0:
+		raise DebrepError("Server closed the connection")
+	return json.loads(line)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+	"""Pass a request to the writer and wait for its result"""
+
+	def handle(self):
+		line = self.rfile.readline()
+		if len(line) == 0: return
+		try:
+			msg = json.loads(line)
+			req = types.SimpleNamespace(argv=list(msg['argv']),
+				cwd=msg['cwd'], done=threading.Event(),
+				status=0, stdout='', stderr='')
+		except (ValueError, KeyError, TypeError) as e:
+			req = types.SimpleNamespace(status=2, stdout='',
+				stderr='debrep: error: invalid request: {}\n'.format(e))
+		else:
+			self.server.writer.queue.put(req)
+			req.done.wait()
+		self.wfile.write(json.dumps(dict(status=req.status,
+			stdout=req.stdout, stderr=req.stderr)).encode() + b'\n')
+
+
+class _SocketServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+
+class Server:
+	"""
+	Base class of the debrep server, see the module documentation
+	"""
+
+	def __init__(self, path, debounce):
+		self.path = path
+		self.debounce = debounce
+		self.queue = queue.Queue()
+
+	def execute(self, req):
+		req.status = 2
+		req.stderr = 'debrep: error: command not served: {}\n'.format(
+			' '.join(req.argv))
+		return False
+
+	def publish(self):
+		pass
+
+	def bind(self):
+		"""Create the socket, replacing a stale one"""
+		if os.path.exists(self.path):
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+				try:
+					s.connect(self.path)
+				except ConnectionRefusedError:
+					os.remove(self.path)
+				else:
+					raise DebrepError("Server already running at {}"
+						.format(self.path))
+		return _SocketServer(self.path, _Handler)
+
+	def publishBatch(self, waiting):
+		"""Publish and answer all requests waiting for it"""
+		try:
+			self.publish()
+		except Exception as e:
+			logger.exception("Publishing failed")
+			for req in waiting:
+				req.status = 1
+				req.stderr += 'debrep: error: publishing failed: {}\n'.format(e)
+		for req in waiting:
+			req.done.set()
+
+	def run(self):
+		"""Serve requests until interrupted"""
+		srv = self.bind()
+		srv.writer = self
+		threading.Thread(target=srv.serve_forever, daemon=True).start()
+		logger.info("Serving at %s", self.path)
+		waiting = []
+		deadline = None
+		try:
+			while True:
+				timeout = None
+				if deadline is not None:
+					timeout = max(0, deadline - time.monotonic())
+				try:
+					req = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					logger.debug("Publish changes of %d requests",
+						len(waiting))
+					self.publishBatch(waiting)
+					waiting = []
+					deadline = None
+					continue
+				logger.debug("Request %s", ' '.join(req.argv))
+				try:
+					changed = self.execute(req)
+				except BaseException:
+					req.done.set()
+					raise
+				if not changed:
+					req.done.set()
+					continue
+				waiting.append(req)
+				if deadline is None:
+					deadline = time.monotonic() + self.debounce
+		finally:
+			srv.shutdown()
+			srv.server_close()
+			os.remove(self.path)
+			if len(waiting) > 0:
+				self.publishBatch(waiting)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Sign Release files with gpg
+
+A signer implements sign(self, jobs), where jobs is a list of
+(Release file, key) tuples. For each Release file, the detached
+signature Release.gpg and the inline signed InRelease are written next
+to it. key is None for the default key.
+"""
+import concurrent.futures
+import logging
+import os.path
+import subprocess
+
+from error import SignError
+
+logger = logging.getLogger(__name__)
+
+class Signer:
+
+	def __init__(self, config):
+		self.gpgargs = ['gpg', '--no-tty', '--batch']
+		if config.gpghome is not None:
+			self.gpgargs += ['--homedir', config.gpghome]
+		self.workers = config.signworkers
+
+	def signOne(self, relfile, key):
+		"""Create both signatures of a single Release file"""
+		logger.debug("Sign %s", relfile)
+		args = self.gpgargs[:]
+		if key is not None:
+			args += ['--local-user', key]
+		inlfile = os.path.join(os.path.dirname(relfile), 'InRelease')
+		for mode, outfile in (('--detach-sign', relfile + '.gpg'),
+				('--clearsign', inlfile)):
+			res = subprocess.run(args + [
+				'--yes', mode, '-o', outfile + '.new', relfile
+			])
+			if res.returncode != 0:
+				raise SignError("Signing {} failed".format(relfile))
+		# replace, the old files may be hardlinked into the published tree
+		os.replace(relfile + '.gpg.new', relfile + '.gpg')
+		os.replace(inlfile + '.new', inlfile)
+
+	def sign(self, jobs):
+		"""Sign all Release files, in parallel with several workers"""
+		if self.workers <= 1 or len(jobs) <= 1:
+			for relfile, key in jobs:
+				self.signOne(relfile, key)
+			return
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as ex:
+			for future in [ex.submit(self.signOne, *job) for job in jobs]:
+				future.result()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Signer leaving Release files unsigned
+
+Meant for tests and for repositories signed by other means. Stale
+signatures are removed, as they would not match the new Release file.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class Signer:
+
+	def __init__(self, config):
+		pass
+
+	def sign(self, jobs):
+		for relfile, key in jobs:
+			logger.debug("Leave %s unsigned", relfile)
+			for fname in (relfile + '.gpg',
+					os.path.join(os.path.dirname(relfile), 'InRelease')):
+				if os.path.exists(fname): os.remove(fname)
@@ -12,6 +12,7 @@ import shutil
 
 from basestore import BaseStore
 from error import StoreError
+from package import BinPkgRef
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,9 @@ def relname2symtarget(fname):
 
 class Store(BaseStore):
 
+	# files live below the directory of their release
+	snapshots = False
+
 	def __init__(self, config):
 		super().__init__(config)
 		self.db = config.getDb()
@@ -44,7 +48,9 @@ class Store(BaseStore):
 		"""
 		self.binPrepareAdd(pkg, component, release)
 		slist = Symreflist(self.releases, self.root)
-		slist.setRefs(self.db.binGetRefs(pkg.id))
+		# the new reference is in the db already, but not yet on disk
+		slist.setRefs([r for r in self.db.binGetRefs(pkg.id)
+			if r.Codename != release])
 		slist.addRef(pkg, component, release)
 
 	def binDelRef(self, refs):
@@ -53,6 +59,125 @@ class Store(BaseStore):
 		slist.setRefs(refs)
 		slist.delRef()
 
+	def binAddRefs(self, refs, release):
+		"""
+		Add symlinks for existing packages to a release
+
+		Usually the real file is in an older release than the new one,
+		so the symlinks are created directly. Otherwise the real file is
+		moved into the new release as in binAddRef.
+		"""
+		relno = self.releases[release].no
+		dirs = set()
+		for ref in refs:
+			ref.newFilename = os.path.join('dists', release, ref.component,
+				os.path.basename(ref.Filename))
+			dirname = os.path.dirname(ref.newFilename)
+			if dirname not in dirs:
+				os.makedirs(os.path.join(self.root, dirname), exist_ok=True)
+				dirs.add(dirname)
+			src = os.path.join(self.root, ref.Filename)
+			if os.path.islink(src):
+				# all symlinks have the same depth, so they can be copied
+				target = os.readlink(src)
+			else:
+				target = relname2symtarget(ref.Filename)
+			# target is ../../<release>/<component>/<file>
+			if self.releases[target.split('/')[2]].no < relno:
+				os.symlink(target, os.path.join(self.root, ref.newFilename))
+				continue
+			new = BinPkgRef(**ref.__dict__)
+			new.Codename = release
+			new.Filename = ref.newFilename
+			slist = Symreflist(self.releases, self.root)
+			slist.setRefs(self.db.binGetRefs(ref.id))
+			slist.addRef(new, ref.component, release)
+
+	def binMoveNames(self, moves):
+		for move in moves:
+			move.newFilename = os.path.join('dists', move.newCodename,
+				move.newcomp, os.path.basename(move.Filename))
+
+	def binMoveRefs(self, moves):
+		"""
+		Move references, keeping the real file in the oldest release
+
+		If a move fails, the files already moved are moved back.
+		"""
+		# Where the file of each move is now, by its reference in the
+		# db, which already holds the new places
+		where = dict(((m.id, m.newrel),
+				(m.idrel, m.Codename, m.component, m.Filename))
+			for m in moves)
+		done = []
+		try:
+			for move in moves:
+				self.moveFile(move, where, move.newrel, move.newCodename,
+					move.newcomp, move.newFilename)
+				done.append(move)
+		except:
+			for move in reversed(done):
+				try:
+					self.moveFile(move, where, move.idrel, move.Codename,
+						move.component, move.Filename)
+				except Exception as e:
+					logger.error("Cannot move %s back: %s", move, e)
+			raise
+
+	def moveFile(self, move, where, idrel, release, component, filename):
+		"""Move the file of a reference of binMoveRefs to the given place"""
+		refs = self.db.binGetRefs(move.id)
+		for ref in refs:
+			if (ref.id, ref.idrel) in where:
+				ref.idrel, ref.Codename, ref.component, ref.Filename = \
+					where[(ref.id, ref.idrel)]
+		current = where[(move.id, move.newrel)][0]
+		ref = next(r for r in refs if r.idrel == current)
+		slist = Symreflist(self.releases, self.root)
+		slist.setRefs(refs)
+		slist.moveRef(ref, release, component, filename)
+		where[(move.id, move.newrel)] = (idrel, release, component, filename)
+
+
+	def storedFiles(self):
+		for release in self.releases.values():
+			for component in release.components:
+				compdir = os.path.join('dists', release.name, component)
+				try:
+					names = os.listdir(os.path.join(self.root, compdir))
+				except FileNotFoundError:
+					continue
+				for name in names:
+					# Contents indices share the directory
+					if name.startswith('Contents-'): continue
+					path = os.path.join(compdir, name)
+					if os.path.isdir(os.path.join(self.root, path)): continue
+					yield path
+
+	def checkRefs(self, refs):
+		"""
+		Check that the oldest reference holds the file and all others
+		are symlinks to it
+		"""
+		unknown = [r for r in refs if r.Codename not in self.releases]
+		if len(unknown) > 0:
+			return ['%s: release not configured' % r for r in unknown]
+		refs = sorted(refs, key=lambda r: self.releases[r.Codename].no)
+		primary = os.path.join(self.root, refs[0].Filename)
+		problems = []
+		if os.path.islink(primary):
+			problems.append('%s: symlink, real file expected' % refs[0])
+		target = relname2symtarget(refs[0].Filename)
+		for ref in refs[1:]:
+			path = os.path.join(self.root, ref.Filename)
+			if not os.path.islink(path):
+				if os.path.lexists(path):
+					problems.append('%s: real file, symlink expected' % ref)
+			elif os.readlink(path) != target:
+				problems.append('%s: symlink does not point to %s'
+					% (ref, refs[0].Filename))
+		return problems
+
 
 class Symreflist:
 	"""
@@ -146,6 +271,27 @@ class Symreflist:
 			refs.insert(0, pkg)
 		self.movePrimary(0)
 
+	def moveRef(self, ref, release, component, filename):
+		"""Move a reference to another release and component"""
+		abspath = os.path.join(self.root, filename)
+		os.makedirs(os.path.dirname(abspath), exist_ok=True)
+		# symlink targets stay valid, as all refs are at the same depth
+		os.replace(ref.abspath, abspath)
+		ref.abspath = abspath
+		ref.Filename = filename
+		ref.Codename = release
+		ref.component = component
+		if ref is self.primaryRef:
+			# redirect symlinks pointing to the old place
+			self.getPrimaryTarget()
+			for r in self.refs:
+				if not getattr(r, 'islink', False): continue
+				os.remove(r.abspath)
+				os.symlink(self.primaryTarget, r.abspath)
+		# the real file must be in the oldest release
+		self.refs.sort(key=lambda r: self.relno(r.Codename))
+		self.movePrimary(0)
+
 	def delRef(self):
 		"""Delete the first reference"""
 		d = self.refs[0]
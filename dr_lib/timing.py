@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Measure wall and CPU time spent in the phases of a debrep run
+
+Timing is off until start() is called, phase() then costs next to
+nothing. A phase may be entered many times, e.g. once per package, and
+from several threads, its calls, times and counters add up. The CPU
+time of a phase is that of the thread running it, so phases running in
+parallel threads are accounted for separately.
+
+Worker processes start with timing as their parent had it. They call
+reset() before a job and pass take() back with its result, which the
+parent adds with merge().
+"""
+import contextlib
+import os
+import threading
+import time
+
+# Name of a phase -> [calls, wall, cpu, rows, bytes]
+_phases = None
+_lock = threading.Lock()
+
+_fields = ('calls', 'wall', 'cpu', 'rows', 'bytes')
+
+def start():
+	"""Start timing, dropping all results so far"""
+	global _phases
+	_phases = {}
+
+def stop():
+	"""Stop timing, dropping all results"""
+	global _phases
+	_phases = None
+
+def enabled():
+	return _phases is not None
+
+def reset():
+	if _phases is not None: start()
+
+def add(name, calls=0, wall=0.0, cpu=0.0, rows=0, bytes=0):
+	if _phases is None: return
+	with _lock:
+		p = _phases.setdefault(name, [0, 0.0, 0.0, 0, 0])
+		p[0] += calls
+		p[1] += wall
+		p[2] += cpu
+		p[3] += rows
+		p[4] += bytes
+
+def count(name, rows=0, bytes=0):
+	"""Add the number of rows read and bytes written to a phase"""
+	add(name, rows=rows, bytes=bytes)
+
+@contextlib.contextmanager
+def phase(name):
+	"""Context measuring one call of a phase"""
+	if _phases is None:
+		yield
+		return
+	wall, cpu = time.perf_counter(), time.thread_time()
+	try:
+		yield
+	finally:
+		add(name, 1, time.perf_counter() - wall, time.thread_time() - cpu)
+
+def take():
+	"""Return the results so far as a list and reset them"""
+	if _phases is None: return []
+	with _lock:
+		result = [(name, tuple(p)) for name, p in _phases.items()]
+		_phases.clear()
+	return result
+
+def merge(taken):
+	"""Add results returned by take() in another process"""
+	for name, p in taken:
+		add(name, *p)
+
+def results():
+	"""Return a list of (phase name, dict of values) in order of entry"""
+	with _lock:
+		return [(name, dict(zip(_fields, p))) for name, p in _phases.items()]
+
+def report(file):
+	"""Write the results as a table"""
+	print('{:<40} {:>8} {:>10} {:>10} {:>10} {:>12}'.format(
+		'phase', 'calls', 'wall [s]', 'cpu [s]', 'rows', 'bytes'), file=file)
+	for name, v in results():
+		print('{:<40} {:>8} {:>10.3f} {:>10.3f} {:>10} {:>12}'.format(
+			name, v['calls'], v['wall'], v['cpu'], v['rows'], v['bytes']),
+			file=file)
+
+_metrics = (
+	('calls', 'calls', 'Number of times a phase was run'),
+	('wall', 'seconds', 'Wall time spent in a phase'),
+	('cpu', 'cpu_seconds', 'CPU time spent in a phase'),
+	('rows', 'rows_read', 'Database rows read in a phase'),
+	('bytes', 'bytes_written', 'Bytes written in a phase'),
+)
+
+def _label(s):
+	return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def writePrometheus(path, command):
+	"""
+	Write the results of the last run of command in the text format of
+	the Prometheus node exporter's textfile collector
+
+	The file is written under a temporary name and renamed, so the
+	collector never reads a partial file.
+	"""
+	res = results()
+	lines = []
+	for field, metric, help in _metrics:
+		lines.append('# HELP debrep_phase_{} {}'.format(metric, help))
+		lines.append('# TYPE debrep_phase_{} gauge'.format(metric))
+		for name, v in res:
+			lines.append('debrep_phase_{}{{command="{}",phase="{}"}} {}'.format(
+				metric, _label(command), _label(name), v[field]))
+	lines.append('# HELP debrep_last_run_timestamp_seconds '
+		'Time the last run of a command finished')
+	lines.append('# TYPE debrep_last_run_timestamp_seconds gauge')
+	lines.append('debrep_last_run_timestamp_seconds{{command="{}"}} {}'.format(
+		_label(command), time.time()))
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	os.replace(tmp, path)